@@ -0,0 +1,369 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmark of the output formats of ``FormatsProtocol.read``.
+
+Synthetic layers of points, lines or polygons with mixed attribute types are
+generated in an in-memory SQLite database, every format is read from them and
+the throughput, the output size and the peak memory are reported as JSON:
+
+    python -m papyrus_formats.benchmark --rows 1000 100000 --output new.json
+
+Every format and layer size runs in a fresh interpreter, so that its
+``max_rss`` is the peak resident memory of that run alone and not the high
+water mark of all runs before it. ``setup_rss`` is the peak after the
+synthetic layer was built, before the format was read.
+
+With ``--baseline`` the results are compared with an earlier run and the
+command fails if a format got slower than the given threshold.
+
+With ``--imports`` the protocol module is additionally imported in a fresh
+interpreter, and the import time, the resident memory and the heavy format
+dependencies it loaded are reported, which is what a GeoJSON-only worker
+pays at startup.
+
+SQLite has no spatial functions, so the geometries are stored as WKB in a
+blob column and the shapefile is built from that column directly instead of
+the ``ST_Transform``-ed geometry of ``read(format='shp')``.
+"""
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 1:04:33 PM$"
+
+import argparse
+import geojson
+import math
+import numpy as np
+import resource
+from papyrus_formats.cache import copy_result
+from papyrus_formats.jobs import JobRequest
+from papyrus_formats.protocol import FormatsProtocol
+from shapely.geometry import LineString
+from shapely.geometry import Point
+from shapely.geometry import Polygon
+from shapely.wkb import loads
+import simplejson as json
+import subprocess
+from sqlalchemy import Column
+from sqlalchemy import Float
+from sqlalchemy import Integer
+from sqlalchemy import LargeBinary
+from sqlalchemy import String
+from sqlalchemy import create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+import sys
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+FORMATS = ('geojson', 'ext', 'hist', 'xls', 'shp')
+
+GEOMETRY_TYPES = ('point', 'line', 'polygon')
+
+# The xls format is limited to 65,536 rows including the header
+XLS_MAX_ROWS = 65535
+
+ATTRS = "name,value,count"
+
+# Dependencies of single formats which shouldn't be loaded on import
+HEAVY_MODULES = ('matplotlib', 'numpy', 'shapely', 'pyproj', 'xlwt', 'xlsxwriter', 'shapefile', 'pyarrow', 'fiona', 'mapbox_vector_tile')
+
+IMPORT_PROBE = """
+import json
+import resource
+import sys
+import time
+start = time.time()
+import %(module)s
+wall = time.time() - start
+sys.stdout.write(json.dumps({
+    'module': %(module)r,
+    'wall': wall,
+    'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'loaded': [m for m in %(heavy)r if m in sys.modules]
+}))
+"""
+
+RUN_PROBE = """
+import json
+import resource
+import sys
+from papyrus_formats.benchmark import make_layer
+from papyrus_formats.benchmark import run
+protocol = make_layer(%(geometry)r, %(rows)d, vertices=%(vertices)d)
+setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+result = run(protocol, %(format)r, %(rows)d)
+result['setup_rss'] = setup_rss
+sys.stdout.write(json.dumps(result))
+"""
+
+class CountingFile(object):
+    """
+    A file-like sink that only counts the bytes written to it.
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+def make_mapped_class(geometry_type):
+    """
+    Return a mapped class with string, float and integer attributes and a
+    WKB geometry, and its declarative base.
+    """
+
+    Base = declarative_base()
+
+    class Feature(Base):
+        __tablename__ = "bench_%s" % geometry_type
+
+        id = Column(Integer, primary_key=True)
+        name = Column(String(40))
+        value = Column(Float)
+        count = Column(Integer)
+        wkb_geometry = Column(LargeBinary)
+
+        @property
+        def __geo_interface__(self):
+            return geojson.Feature(id=self.id,
+                                   geometry=loads(bytes(self.wkb_geometry)),
+                                   properties={'name': self.name, 'value': self.value, 'count': self.count})
+
+    return Feature, Base
+
+def make_geometry(geometry_type, x, y, vertices):
+
+    if geometry_type == 'point':
+        return Point(x, y)
+
+    angles = np.linspace(0, 2 * math.pi, vertices, endpoint=False)
+    xs = x + 0.01 * np.cos(angles)
+    ys = y + 0.01 * np.sin(angles)
+
+    if geometry_type == 'line':
+        return LineString(list(zip(xs, ys)))
+
+    return Polygon(list(zip(xs, ys)))
+
+def make_layer(geometry_type, rows, vertices=64, seed=0):
+    """
+    Create an in-memory SQLite database with ``rows`` synthetic features and
+    return a protocol reading them.
+    """
+
+    Feature, Base = make_mapped_class(geometry_type)
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    Session = scoped_session(sessionmaker(bind=engine))
+
+    random = np.random.RandomState(seed)
+    xs = random.uniform(-180, 180, rows)
+    ys = random.uniform(-90, 90, rows)
+    values = random.normal(100, 25, rows)
+    counts = random.randint(0, 1000, rows)
+
+    features = []
+    for i in range(rows):
+        features.append({
+            'id': i + 1,
+            'name': u"feature %d" % i,
+            'value': float(values[i]),
+            'count': int(counts[i]),
+            'wkb_geometry': make_geometry(geometry_type, xs[i], ys[i], vertices).wkb
+        })
+
+    engine.execute(Feature.__table__.insert(), features)
+
+    return FormatsProtocol(Session, Feature, 'wkb_geometry')
+
+def read_format(protocol, format, rows):
+    """
+    Read ``format`` from ``protocol`` and return the result.
+    """
+
+    mapped_class = protocol.mapped_class
+    request = JobRequest({'attrs': ATTRS, 'limit': str(rows)})
+    filter = mapped_class.id != None
+
+    if format == 'hist':
+        request = JobRequest({'attrs': 'value'})
+        return protocol.read(request, filter=filter, format='hist', categories=None)
+
+    if format == 'ext':
+        return protocol.read(request, filter=filter, format='ext', name_mapping=None)
+
+    if format == 'shp':
+        columns = [mapped_class.wkb_geometry.label("geometry_column")]
+        columns.extend(getattr(mapped_class, a) for a in ATTRS.split(","))
+        query = protocol.Session.query(* columns).filter(filter)
+        return protocol._read_shp(request, query)
+
+    return protocol.read(request, filter=filter, format=format)
+
+def run(protocol, format, rows):
+    """
+    Run one benchmark and return its measurements.
+    """
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+    start = time.time()
+
+    sink = CountingFile()
+    copy_result(read_format(protocol, format, rows), sink)
+
+    wall = time.time() - start
+
+    peak = None
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    protocol.Session.remove()
+
+    return {
+        'wall': wall,
+        'bytes': sink.size,
+        'rows_per_s': rows / wall if wall > 0 else None,
+        'bytes_per_s': sink.size / wall if wall > 0 else None,
+        'peak_traced': peak,
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+def measure_run(geometry_type, rows, format, vertices=64):
+    """
+    Run one benchmark in a new interpreter and return its measurements,
+    including the maximum resident memory of that interpreter.
+    """
+
+    output = subprocess.check_output([sys.executable, "-c", RUN_PROBE % {
+        'geometry': geometry_type, 'rows': rows, 'format': format, 'vertices': vertices}])
+
+    return json.loads(output.decode("utf-8"))
+
+def measure_import(module="papyrus_formats.protocol"):
+    """
+    Import ``module`` in a new interpreter and return the import time, the
+    maximum resident memory and the heavy dependencies it loaded.
+    """
+
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_PROBE % {'module': module, 'heavy': HEAVY_MODULES}])
+
+    return json.loads(output.decode("utf-8"))
+
+def benchmark(sizes, geometry_types=GEOMETRY_TYPES, formats=FORMATS, vertices=64):
+    """
+    Run all benchmarks, each in a new interpreter, and return the list of
+    results.
+    """
+
+    results = []
+
+    for geometry_type in geometry_types:
+        for rows in sizes:
+            for format in formats:
+                if format == 'xls' and rows > XLS_MAX_ROWS:
+                    continue
+
+                result = measure_run(geometry_type, rows, format, vertices=vertices)
+                result.update({'format': format, 'geometry': geometry_type, 'rows': rows, 'vertices': vertices})
+                results.append(result)
+
+                sys.stderr.write("%(format)-8s %(geometry)-8s %(rows)8d rows %(wall)8.3fs\n" % result)
+
+    return results
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Compare the wall times of ``results`` with those of ``baseline`` and
+    return the comparisons, each with the ratio of the new to the old time
+    and whether it's a regression (slower by more than ``threshold``).
+    """
+
+    def key(r):
+        return (r['format'], r['geometry'], r['rows'], r.get('vertices'))
+
+    old = dict((key(r), r) for r in baseline)
+
+    comparisons = []
+    for r in results:
+        b = old.get(key(r))
+        if b is None or not b['wall']:
+            continue
+
+        ratio = r['wall'] / b['wall']
+        comparisons.append({
+            'format': r['format'],
+            'geometry': r['geometry'],
+            'rows': r['rows'],
+            'baseline_wall': b['wall'],
+            'wall': r['wall'],
+            'ratio': ratio,
+            'regression': ratio > 1 + threshold
+        })
+
+    return comparisons
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the output formats of FormatsProtocol")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--geometry", nargs="+", choices=GEOMETRY_TYPES, default=list(GEOMETRY_TYPES))
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=list(FORMATS))
+    parser.add_argument("--vertices", type=int, default=64, help="vertices per line or polygon")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown before a run counts as regression")
+    parser.add_argument("--imports", action="store_true", help="measure the import of the protocol module too")
+    args = parser.parse_args(argv)
+
+    report = {'results': benchmark(args.rows, args.geometry, args.formats, args.vertices)}
+
+    if args.imports:
+        report['imports'] = measure_import()
+
+    if args.baseline is not None:
+        f = open(args.baseline)
+        baseline = json.load(f)
+        f.close()
+        report['comparison'] = compare(report['results'], baseline['results'], args.threshold)
+
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        f = open(args.output, 'w')
+        f.write(output)
+        f.close()
+    else:
+        print(output)
+
+    if any(c['regression'] for c in report.get('comparison', [])):
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 5:31:18 PM$"
+
+import logging
+import os
+from papyrus_formats.cache import copy_result
+from papyrus_formats.jobs import JobRequest
+from papyrus_formats.jobs import extensions
+import shutil
+from tempfile import mkdtemp
+import threading
+try:
+    from Queue import Empty
+    from Queue import Queue
+except ImportError:
+    from queue import Empty
+    from queue import Queue
+
+log = logging.getLogger(__name__)
+
+class BundleLayer(object):
+    """
+    A layer of a bundle: the ``protocol`` of its mapped class, the ``attrs``
+    to export and the ``name`` of its files in the archive.
+    """
+
+    def __init__(self, name, protocol, attrs):
+
+        self.name = name
+        self.protocol = protocol
+        self.attrs = attrs
+
+def export_bundle(layers, params, format='shp', metadata=None, workers=4, ** kwargs):
+    """
+    Export several layers (``BundleLayer``) with the same filter parameters
+    ``params`` (bbox, geometry, ...) into one ZIP archive, returned in a
+    spooled temporary file.
+
+    The layers are queried and written concurrently by ``workers`` threads,
+    which also bounds the number of database connections in use. The
+    sessions of the protocols should be ``scoped_session``s; every worker
+    removes its session after each layer.
+
+    Shapefiles are put into the archive as ``<name>.shp``, ``<name>.dbf``,
+    ... and other formats as one ``<name>.<extension>`` file each. Layers
+    without features are left out of shapefile bundles. The
+    ``metadata`` is added once as metadata.xls. The keyword arguments (epsg,
+    reproject, ...) are passed to the export of every layer.
+    """
+
+    names = [layer.name for layer in layers]
+    if len(set(names)) != len(names):
+        raise ValueError("The layer names of a bundle must be unique")
+
+    directory = mkdtemp()
+
+    try:
+        members = _write_layers(layers, params, format, directory, workers, kwargs)
+
+        return layers[0].protocol._zip_members(directory, members, metadata, format=format)
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def _write_layers(layers, params, format, directory, workers, kwargs):
+    """
+    Write the files of all layers to ``directory`` in a pool of threads and
+    return the names of the written files in the order of the layers. The
+    first error of a layer is raised once all workers are done.
+    """
+
+    queue = Queue()
+    for i, layer in enumerate(layers):
+        queue.put((i, layer))
+
+    members = [None] * len(layers)
+    errors = []
+
+    def work():
+        while True:
+            # All layers are queued before the workers start
+            try:
+                i, layer = queue.get_nowait()
+            except Empty:
+                break
+
+            try:
+                members[i] = _write_layer(layer, params, format, directory, kwargs)
+            except Exception as e:
+                log.exception("Export of layer %s failed" % layer.name)
+                errors.append(e)
+            finally:
+                if hasattr(layer.protocol.Session, "remove"):
+                    layer.protocol.Session.remove()
+
+    threads = []
+    for i in range(min(workers, len(layers))):
+        t = threading.Thread(target=work, name="bundle-worker-%d" % i)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    return [name for names in members for name in names]
+
+def _write_layer(layer, params, format, directory, kwargs):
+
+    protocol = layer.protocol
+
+    layer_params = dict(params)
+    layer_params['attrs'] = layer.attrs
+    request = JobRequest(layer_params)
+
+    if format == 'shp':
+        epsg = kwargs.get("epsg", 4326)
+        query, reproject = protocol._export_query(request, None, epsg, kwargs.get("reproject"))
+
+        # A shapefile needs a first feature for its shape type and fields
+        if query.first() is None:
+            log.info("Layer %s has no features, it's left out of the bundle" % layer.name)
+            return []
+
+        return protocol._write_shp_files(request, query, directory, basename=layer.name, epsg=epsg, reproject=reproject)
+
+    name = "%s.%s" % (layer.name, extensions.get(format, "dat"))
+
+    f = open(os.path.join(directory, name), 'wb')
+    try:
+        copy_result(protocol.read(request, format=format, ** kwargs), f)
+    finally:
+        f.close()
+
+    return [name]
@@ -0,0 +1,299 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 10:41:05 AM$"
+
+from collections import OrderedDict
+import errno
+import hashlib
+import os
+import shutil
+import simplejson as json
+from tempfile import mkdtemp
+from tempfile import mkstemp
+import threading
+import time
+
+def normalize_params(params, ignore=("_dc", "callback")):
+    """
+    Return the request parameters ``params`` as a sorted tuple of (key,
+    value) pairs, leaving out the keys in ``ignore`` (e.g. the cache buster
+    added by Ext). The result can be used as or in a cache key.
+    """
+
+    if hasattr(params, "items"):
+        params = params.items()
+
+    return tuple(sorted((k, v) for k, v in params if k not in ignore))
+
+class LRUCache(object):
+    """
+    A thread-safe least recently used cache whose total size is bounded by
+    ``max_size``. The size of a value is computed with ``sizeof``, by default
+    its length, so a cache of strings is bounded by its number of bytes.
+
+    Every entry can carry a version token. Looking up an entry with another
+    version than the one it was stored with drops the entry, so a cache can be
+    invalidated by passing e.g. the version of the underlying table.
+    """
+
+    def __init__(self, max_size=32 * 1024 * 1024, sizeof=len):
+
+        self.max_size = max_size
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, version=None):
+        """
+        Return the value of ``key`` or None if it's not cached or was stored
+        with another version.
+        """
+
+        with self._lock:
+            try:
+                entry_version, value, size = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            if entry_version != version:
+                self._size -= size
+                return None
+
+            # Put the entry back as the most recently used one
+            self._entries[key] = (entry_version, value, size)
+
+            return value
+
+    def set(self, key, value, version=None):
+
+        size = self._sizeof(value)
+
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[2]
+
+            # Values bigger than the whole cache are not stored at all
+            if size > self.max_size:
+                return
+
+            self._entries[key] = (version, value, size)
+            self._size += size
+
+            # Evict the least recently used entries
+            while self._size > self.max_size:
+                self._size -= self._entries.popitem(last=False)[1][2]
+
+    def invalidate(self, key=None):
+        """
+        Drop the entry ``key``, or all entries if no key is given.
+        """
+
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._size = 0
+            elif key in self._entries:
+                self._size -= self._entries.pop(key)[2]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size(self):
+        return self._size
+
+def request_digest(* parts):
+    """
+    Return a SHA-1 hex digest of ``parts`` serialized as canonical JSON.
+    Values which aren't JSON serializable are serialized as strings.
+    """
+
+    canonical = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+
+    if isinstance(canonical, unicode):
+        canonical = canonical.encode("UTF-8")
+
+    return hashlib.sha1(canonical).hexdigest()
+
+def copy_result(result, f):
+    """
+    Write a result of ``FormatsProtocol.read``, i.e. a string, a file-like
+    object or an iterator of chunks, to the file ``f``.
+    """
+
+    if hasattr(result, "read"):
+        result.seek(0)
+        shutil.copyfileobj(result, f)
+        result.close()
+    elif isinstance(result, basestring):
+        f.write(result)
+    else:
+        for chunk in result:
+            f.write(chunk)
+
+class ArtifactCache(object):
+    """
+    A disk cache for built export artifacts in ``directory``, addressed by a
+    key such as a ``request_digest``.
+
+    The cache is bounded by the total size ``max_size`` of its files, the
+    least recently used ones are removed first, and files older than
+    ``max_age`` seconds are removed as well. Concurrent requests for the same
+    missing key are coalesced, so that only one of them builds the artifact.
+    """
+
+    def __init__(self, directory=None, max_size=1024 * 1024 * 1024, max_age=24 * 3600):
+
+        self.directory = directory if directory is not None else mkdtemp()
+        self.max_size = max_size
+
+        # Several processes may share and create the same directory
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._building = {}
+
+    def get(self, key):
+        """
+        Return the cached artifact of ``key`` opened for reading, or None if
+        it isn't cached or older than ``max_age``.
+        """
+
+        path = self._path(key)
+
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        now = time.time()
+        mtime = os.fstat(f.fileno()).st_mtime
+
+        # An expired artifact is a miss, even before the next eviction
+        if now - mtime > self.max_age:
+            f.close()
+            self._remove(path)
+            return None
+
+        # Record the access for the LRU eviction but keep the modification
+        # time, which is the age of the artifact
+        try:
+            os.utime(path, (now, mtime))
+        except OSError:
+            pass
+
+        return f
+
+    def get_or_build(self, key, build):
+        """
+        Return the artifact of ``key`` opened for reading. If it isn't cached,
+        ``build`` is called to create it; its result is written to the cache.
+        """
+
+        while True:
+            f = self.get(key)
+            if f is not None:
+                return f
+
+            with self._lock:
+                event = self._building.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._building[key] = event
+                    builder = True
+                else:
+                    builder = False
+
+            if not builder:
+                # Another thread builds the same artifact, wait for it and try
+                # to read it again (or build it if that build failed)
+                event.wait()
+                continue
+
+            try:
+                self._store(key, build())
+            finally:
+                with self._lock:
+                    del self._building[key]
+                event.set()
+
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the expired artifacts and, if the cache is still too big, the
+        least recently used ones.
+        """
+
+        now = time.time()
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith("."):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            if now - stat.st_mtime > self.max_age:
+                self._remove(path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, path))
+
+        total = sum(e[1] for e in entries)
+        for atime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    def _store(self, key, result):
+
+        # Write to a hidden temporary file first, so that readers never see a
+        # partially written artifact
+        fd, tmp = mkstemp(prefix=".", dir=self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            copy_result(result, f)
+        except:
+            f.close()
+            self._remove(tmp)
+            raise
+
+        f.close()
+        os.rename(tmp, self._path(key))
+
+    def _path(self, key):
+
+        return os.path.join(self.directory, key)
+
+    def _remove(self, path):
+
+        try:
+            os.remove(path)
+        except OSError:
+            pass
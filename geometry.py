@@ -0,0 +1,258 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 9:12:40 AM$"
+
+import math
+import numpy as np
+from papyrus_formats.projection import reproject_geometries
+from shapely.ops import transform
+from shapely.wkb import loads
+try:
+    # Shapely 2 array functions
+    from shapely import clip_by_rect
+    from shapely import from_wkb
+    from shapely import is_empty
+    from shapely import is_missing
+    from shapely import to_ragged_array
+    from shapely import to_wkb
+    from shapely import transform as transform_coordinates
+except ImportError:
+    from shapely.ops import clip_by_rect
+    from_wkb = None
+
+# Half of the width of the Web Mercator projection in meters
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+def decode_wkb(values):
+    """
+    Decode a sequence of WKB values (strings, buffers or memoryviews) at once
+    into a NumPy array of geometries.
+    """
+
+    return from_wkb(np.array([None if v is None else bytes(v) for v in values], dtype=object))
+
+def iter_wkb_parts(values, reproject=None):
+    """
+    Yield for each WKB value in ``values`` the list of its parts, where each
+    part is a list of [x, y] coordinates: the rings of (multi) polygons, the
+    lines of (multi) linestrings and the points of (multi) points. Empty or
+    missing geometries yield an empty list.
+
+    With Shapely 2 the whole sequence is decoded in one call and the
+    coordinates are extracted as NumPy arrays with part offsets, otherwise
+    each value is decoded on its own and the coordinates of each part are
+    copied as one NumPy array (see ``geometry_parts``).
+
+    The coordinates are reprojected with ``reproject`` if given, see
+    ``projection.coordinate_transform``.
+    """
+
+    if from_wkb is None:
+        for v in values:
+            if v is None:
+                yield []
+            else:
+                g = loads(bytes(v))
+                if reproject is not None:
+                    g = reproject_geometries([g], reproject)[0]
+                yield geometry_parts(g)
+        return
+
+    geoms = decode_wkb(values)
+
+    if reproject is not None:
+        geoms = reproject_geometries(geoms, reproject)
+
+    valid = ~(is_missing(geoms) | is_empty(geoms))
+
+    try:
+        parts = ragged_parts(geoms[valid])
+    except ValueError:
+        # Mixed geometry families and GeometryCollections can't be put in a
+        # ragged array
+        parts = [geometry_parts(g) for g in geoms[valid]]
+
+    parts = iter(parts)
+    for v in valid:
+        if v:
+            yield next(parts)
+        else:
+            yield []
+
+def ragged_parts(geoms):
+    """
+    Return the list of parts of each geometry in the array ``geoms``, which
+    must hold geometries of a single family (e.g. Polygons and MultiPolygons).
+    """
+
+    count = len(geoms)
+    if count == 0:
+        return []
+
+    geom_type, coords, offsets = to_ragged_array(geoms, include_z=False)
+
+    if len(offsets) == 0:
+        # Points: one part with one coordinate per geometry
+        part_offsets = np.arange(count + 1)
+        geom_offsets = np.arange(count + 1)
+    elif len(offsets) == 1:
+        # LineStrings and MultiPoints: one part per geometry
+        part_offsets = offsets[0]
+        geom_offsets = np.arange(count + 1)
+    else:
+        # Map the geometry offsets down to the innermost level (rings or lines)
+        part_offsets = offsets[0]
+        geom_offsets = offsets[-1]
+        for o in offsets[-2:0:-1]:
+            geom_offsets = o[geom_offsets]
+
+    # Convert the coordinates and offsets to lists in one go, the parts are
+    # then only slices of this list
+    points = coords.tolist()
+    part_offsets = part_offsets.tolist()
+    geom_offsets = geom_offsets.tolist()
+
+    result = []
+    for i in range(count):
+        result.append([points[part_offsets[j]:part_offsets[j + 1]]
+                      for j in range(geom_offsets[i], geom_offsets[i + 1])])
+
+    return result
+
+def geometry_parts(g):
+    """
+    Return the list of parts of a single Shapely geometry ``g``.
+    """
+
+    if g.is_empty:
+        return []
+
+    if g.geom_type == "Point":
+        return [[[g.x, g.y]]]
+
+    if g.geom_type == "MultiPoint":
+        return [coordinate_list([p.coords[0] for p in g.geoms])]
+
+    if g.geom_type == "LineString":
+        return [coordinate_list(g.coords)]
+
+    if g.geom_type == "Polygon":
+        rings = [g.exterior] + list(g.interiors)
+        return [coordinate_list(r.coords) for r in rings]
+
+    parts = []
+    for member in g.geoms:
+        parts.extend(geometry_parts(member))
+
+    return parts
+
+def coordinate_list(coords):
+    """
+    Return the coordinate sequence ``coords`` as list of [x, y] coordinates.
+    The sequence is converted to a NumPy array in one go, which is much
+    faster than reading it point by point with Shapely 1.
+    """
+
+    return np.asarray(coords)[:, :2].tolist()
+
+def zoom_tolerance(zoom, geographic=True):
+    """
+    Return the size of a pixel of a 256 pixel tile at ``zoom``, in degrees
+    for ``geographic`` coordinates, else in meters (Web Mercator). It is a
+    simplification tolerance that's invisible at that zoom level.
+    """
+
+    if geographic:
+        return 360.0 / (256 * 2 ** zoom)
+
+    return 2 * math.pi * 6378137.0 / (256 * 2 ** zoom)
+
+def simplify_geometry(g, tolerance):
+    """
+    Simplify ``g`` with ``tolerance`` while preserving its topology.
+    """
+
+    return g.simplify(tolerance, preserve_topology=True)
+
+def quantize_geometry(g, precision):
+    """
+    Round the coordinates of ``g`` to ``precision`` decimal places.
+    """
+
+    if from_wkb is not None:
+        return transform_coordinates(g, lambda coords: np.round(coords, precision))
+
+    return transform(lambda x, y, z=None: (round(x, precision), round(y, precision)), g)
+
+def tile_bounds(z, x, y, buffer=0.0):
+    """
+    Return the bounds (minx, miny, maxx, maxy) in Web Mercator (EPSG:3857) of
+    the tile ``z``/``x``/``y``, grown by ``buffer`` times the tile size.
+    """
+
+    size = 2 * WEB_MERCATOR_EXTENT / 2 ** z
+
+    minx = -WEB_MERCATOR_EXTENT + x * size
+    maxy = WEB_MERCATOR_EXTENT - y * size
+
+    return (minx - buffer * size, maxy - size - buffer * size,
+            minx + size + buffer * size, maxy + buffer * size)
+
+def decode_clipped(values, bounds):
+    """
+    Decode a sequence of WKB values and clip the geometries to ``bounds``.
+    Missing values give None.
+    """
+
+    if from_wkb is not None:
+        return list(clip_by_rect(decode_wkb(values), * bounds))
+
+    return [None if v is None else clip_by_rect(loads(bytes(v)), * bounds) for v in values]
+
+def reproject_wkb(values, reproject=None):
+    """
+    Return the WKB values reprojected with ``reproject``, or unchanged if it
+    is None. Missing values stay None.
+    """
+
+    if reproject is None:
+        return [None if v is None else bytes(v) for v in values]
+
+    if from_wkb is not None:
+        return list(to_wkb(reproject_geometries(decode_wkb(values), reproject)))
+
+    return [None if v is None else reproject_geometries([loads(bytes(v))], reproject)[0].wkb for v in values]
+
+def decode_geometries(values, reproject=None):
+    """
+    Return the list of geometries of the WKB values, reprojected with
+    ``reproject`` if given. Missing values are returned as None.
+    """
+
+    if from_wkb is not None:
+        geoms = decode_wkb(values)
+        if reproject is not None:
+            geoms = reproject_geometries(geoms, reproject)
+        return list(geoms)
+
+    geoms = [None if v is None else loads(bytes(v)) for v in values]
+    if reproject is not None:
+        geoms = [None if g is None else reproject_geometries([g], reproject)[0] for g in geoms]
+    return geoms
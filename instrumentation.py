@@ -0,0 +1,196 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 2:18:50 PM$"
+
+import bisect
+import threading
+import time
+
+class Span(object):
+    """
+    A timed stage of a read, used as context manager. The stage name is
+    ``name``, ``info`` holds its labels (e.g. the format) and ``counts`` the
+    numbers added with ``add`` (rows, vertices, bytes, ...).
+    """
+
+    enabled = True
+
+    def __init__(self, observer, name, info):
+
+        self.observer = observer
+        self.name = name
+        self.info = info
+        self.counts = {}
+        self.start = None
+        self.duration = None
+
+    def add(self, ** counts):
+
+        for k, v in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + v
+
+    def __enter__(self):
+
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.duration = time.time() - self.start
+        self.info['error'] = exc_type is not None
+        self.observer.record(self)
+
+class NullSpan(object):
+    """
+    A span which records nothing. Callers can check ``enabled`` to skip
+    computing counts nobody looks at.
+    """
+
+    enabled = False
+
+    def add(self, ** counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class Observer(object):
+    """
+    Base class of the observers of ``FormatsProtocol``: ``span`` creates the
+    span of a stage and ``record`` receives it once the stage is finished.
+    """
+
+    def span(self, name, ** info):
+        return Span(self, name, info)
+
+    def record(self, span):
+        pass
+
+class NullObserver(Observer):
+    """
+    The default observer, its spans are no-ops.
+    """
+
+    def span(self, name, ** info):
+        return NULL_SPAN
+
+NULL_OBSERVER = NullObserver()
+
+class CallbackObserver(Observer):
+    """
+    Pass every finished span to ``callback``.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, span):
+        self.callback(span)
+
+class LatencyAggregator(Observer):
+    """
+    Keep a latency histogram and the summed counts per stage and format. The
+    histograms can be read with ``snapshot`` or rendered in the Prometheus
+    text format with ``render``.
+    """
+
+    # Upper bounds in seconds of the histogram buckets
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self, buckets=None):
+
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, span):
+
+        key = (span.name, span.info.get('format'))
+
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = {'buckets': [0] * (len(self.buckets) + 1), 'count': 0, 'sum': 0.0, 'counts': {}}
+                self._stats[key] = stats
+
+            stats['buckets'][bisect.bisect_left(self.buckets, span.duration)] += 1
+            stats['count'] += 1
+            stats['sum'] += span.duration
+            for k, v in span.counts.items():
+                stats['counts'][k] = stats['counts'].get(k, 0) + v
+
+    def snapshot(self):
+        """
+        Return a list with one dictionary per stage and format with the
+        cumulative bucket counts, the number of spans, the total duration and
+        the summed counts.
+        """
+
+        result = []
+
+        with self._lock:
+            for (stage, format), stats in sorted(self._stats.items()):
+                cumulative = []
+                total = 0
+                for n in stats['buckets']:
+                    total += n
+                    cumulative.append(total)
+
+                result.append({
+                    'stage': stage,
+                    'format': format,
+                    'buckets': list(zip(self.buckets + (float('inf'),), cumulative)),
+                    'count': stats['count'],
+                    'sum': stats['sum'],
+                    'counts': dict(stats['counts'])
+                })
+
+        return result
+
+    def render(self, prefix="papyrus_formats"):
+        """
+        Return the histograms in the Prometheus text exposition format.
+        """
+
+        lines = ["# TYPE %s_stage_seconds histogram" % prefix]
+
+        for s in self.snapshot():
+            labels = 'stage="%s",format="%s"' % (s['stage'], s['format'] or "")
+            for bound, n in s['buckets']:
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append('%s_stage_seconds_bucket{%s,le="%s"} %d' % (prefix, labels, le, n))
+            lines.append('%s_stage_seconds_sum{%s} %r' % (prefix, labels, s['sum']))
+            lines.append('%s_stage_seconds_count{%s} %d' % (prefix, labels, s['count']))
+            for k, v in sorted(s['counts'].items()):
+                lines.append('%s_stage_%s_total{%s} %d' % (prefix, k, labels, v))
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+
+        with self._lock:
+            self._stats.clear()
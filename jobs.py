@@ -0,0 +1,249 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 11:26:52 AM$"
+
+import logging
+import os
+from papyrus_formats.cache import copy_result
+from tempfile import mkdtemp
+import threading
+import time
+from uuid import uuid4
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+log = logging.getLogger(__name__)
+
+# File extensions of the built artifacts per format
+extensions = {
+'geojson': 'json',
+'ext': 'json',
+'hist': 'png',
+'hist_json': 'json',
+'xls': 'xls',
+'xlsx': 'xlsx',
+'csv': 'csv',
+'parquet': 'parquet',
+'arrow': 'arrows',
+'fgb': 'fgb',
+'shp': 'zip'
+}
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+class JobRequest(object):
+    """
+    A stand-in for the web request with only the request parameters, which
+    is all ``FormatsProtocol.read`` needs outside of a request.
+    """
+
+    def __init__(self, params):
+
+        self.params = dict(params)
+
+class ExportJob(object):
+
+    def __init__(self, format, params, kwargs):
+
+        self.id = uuid4().hex
+        self.format = format
+        self.params = dict(params)
+        self.kwargs = kwargs
+        self.status = PENDING
+        self.rows = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.filename = None
+        self.error = None
+
+    def to_dict(self):
+
+        return {
+            'id': self.id,
+            'format': self.format,
+            'status': self.status,
+            'rows': self.rows,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'error': self.error
+        }
+
+class ExportJobManager(object):
+    """
+    Runs ``FormatsProtocol.read`` exports outside of the web request in a
+    pool of ``workers`` threads and stores the built artifacts in
+    ``directory`` (a new temporary directory by default).
+
+    The worker threads use the ``Session`` of the protocol, which should be a
+    ``scoped_session`` so that every worker has its own database session; it
+    is removed after each job. Finished jobs and their artifacts are removed
+    ``retention`` seconds after they finished.
+
+    Threads are used rather than processes, since neither the protocol nor
+    its session can be passed to another process.
+    """
+
+    def __init__(self, protocol, directory=None, workers=2, retention=3600):
+
+        self.protocol = protocol
+        self.directory = directory if directory is not None else mkdtemp()
+        self.retention = retention
+
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._queue = Queue()
+
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name="export-worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, format, params, ** kwargs):
+        """
+        Queue an export of ``format`` for the request parameters ``params``
+        (attrs, filter parameters, ...) and return the job id. The keyword
+        arguments (epsg, metadata, ...) are passed to ``read``.
+        """
+
+        self.purge()
+
+        job = ExportJob(format, params, kwargs)
+
+        with self._lock:
+            self._jobs[job.id] = job
+
+        self._queue.put(job)
+
+        return job.id
+
+    def status(self, job_id):
+        """
+        Return the status of a job as dictionary with its ``status``
+        (pending, running, done or failed), the number of ``rows`` written so
+        far and its timestamps. Raises a KeyError for unknown jobs.
+        """
+
+        with self._lock:
+            return self._jobs[job_id].to_dict()
+
+    def open(self, job_id):
+        """
+        Open the artifact of a finished job for reading.
+        """
+
+        with self._lock:
+            job = self._jobs[job_id]
+
+        if job.status != DONE:
+            raise ValueError("Job %s is %s" % (job_id, job.status))
+
+        return open(job.filename, 'rb')
+
+    def purge(self):
+        """
+        Remove the jobs which finished more than ``retention`` seconds ago
+        along with their artifacts.
+        """
+
+        limit = time.time() - self.retention
+
+        with self._lock:
+            expired = [j for j in self._jobs.values() if j.finished is not None and j.finished < limit]
+            for job in expired:
+                del self._jobs[job.id]
+
+        for job in expired:
+            if job.filename is not None and os.path.exists(job.filename):
+                os.remove(job.filename)
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads once the queued jobs are done.
+        """
+
+        for t in self._threads:
+            self._queue.put(None)
+
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _work(self):
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            try:
+                self._run(job)
+            finally:
+                # Give every job a fresh database session
+                if hasattr(self.protocol.Session, "remove"):
+                    self.protocol.Session.remove()
+
+    def _run(self, job):
+
+        job.status = RUNNING
+        job.started = time.time()
+
+        filename = os.path.join(self.directory, "%s.%s" % (job.id, extensions.get(job.format, "dat")))
+
+        def progress(rows):
+            job.rows = rows
+
+        kwargs = dict(job.kwargs)
+        kwargs['progress'] = progress
+        if job.format == 'shp':
+            kwargs.setdefault('spool', True)
+        elif job.format in ('geojson', 'ext'):
+            kwargs.setdefault('stream', True)
+
+        try:
+            result = self.protocol.read(JobRequest(job.params), format=job.format, ** kwargs)
+            self._save(result, filename)
+        except Exception as e:
+            log.exception("Export job %s failed" % job.id)
+            if os.path.exists(filename):
+                os.remove(filename)
+            job.error = str(e)
+            job.status = FAILED
+        else:
+            job.filename = filename
+            job.status = DONE
+
+        job.finished = time.time()
+
+    def _save(self, result, filename):
+
+        f = open(filename, 'wb')
+        try:
+            copy_result(result, f)
+        finally:
+            f.close()
@@ -0,0 +1,88 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 4:07:12 PM$"
+
+import base64
+import datetime
+from decimal import Decimal
+import simplejson as json
+
+def encode_cursor(values):
+    """
+    Return the opaque cursor of a page: the keyset values (sort key and
+    primary key) of its last row as URL safe base64 encoded JSON.
+    """
+
+    def default(o):
+        if isinstance(o, (datetime.date, datetime.datetime)):
+            return o.isoformat()
+        if isinstance(o, Decimal):
+            return str(o)
+        raise TypeError("%r is not JSON serializable" % o)
+
+    return base64.urlsafe_b64encode(json.dumps(list(values), default=default).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """
+    Return the keyset values of ``cursor``. Raises a ValueError if the
+    cursor is malformed.
+    """
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)).decode("utf-8"))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor %r" % cursor)
+
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor %r" % cursor)
+
+    return values
+
+class KeysetPage(object):
+    """
+    Keeps track of the rows of a keyset paginated page as they are iterated
+    over with ``rows``, in order to build the cursor of the next page.
+    ``keys`` returns the keyset values of a row.
+    """
+
+    def __init__(self, keys, limit):
+
+        self.keys = keys
+        self.limit = limit
+        self.count = 0
+        self.last = None
+
+    def rows(self, rows):
+
+        for row in rows:
+            self.count += 1
+            self.last = row
+            yield row
+
+    def next_cursor(self):
+        """
+        Return the cursor of the next page, or None if this page is the
+        last one.
+        """
+
+        if self.limit is None or self.count < self.limit or self.last is None:
+            return None
+
+        return encode_cursor(self.keys(self.last))
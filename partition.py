@@ -0,0 +1,261 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Partitioned shapefile export of very large layers.
+
+The filtered layer is split into partitions by primary key range or by a
+spatial grid, and every partition is written as its own shapefile
+(data_001.shp, data_002.shp, ...) by a pool of worker processes. A partition
+that would exceed the size limit of shapefiles is continued in further
+shapefiles (data_001_2.shp, ...). The shapefiles are put into one ZIP archive
+along with a manifest.json listing the partitions.
+
+Neither the session nor the mapped class can be passed to another process,
+so the workers get the database URL and the dotted path of the mapped class
+('package.module:Class') and open their own connection.
+"""
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 6:14:40 PM$"
+
+import math
+from multiprocessing import Pool
+from multiprocessing import cpu_count
+import os
+from papyrus_formats.jobs import JobRequest
+from papyrus_formats.protocol import FormatsProtocol
+from papyrus_formats.registry import resolve
+from papyrus.protocol import create_filter
+import shutil
+import simplejson as json
+from sqlalchemy import and_
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from tempfile import mkdtemp
+
+# The .shp and .dbf files of a shapefile can't be bigger than 2 GB
+SHP_MAX_SIZE = 2 * 1024 * 1024 * 1024 - 1
+
+def export_partitioned(url, mapped_class, params, by='pk', partitions=None, processes=None, metadata=None, ** kwargs):
+    """
+    Export the layer of the mapped class at the dotted path ``mapped_class``
+    in the database ``url``, filtered with the request parameters ``params``
+    (attrs, bbox, ...), as partitioned shapefile in a ZIP archive, returned
+    in a spooled temporary file.
+
+    The layer is split ``by`` ranges of its integer primary key ('pk') or
+    the cells of a grid over the extent of the features ('grid'), a feature
+    belongs to the cell of its centroid. There are ``partitions`` partitions, by default
+    one per worker process. ``processes`` is the number of worker processes,
+    by default the number of cores. The keyword arguments (epsg, reproject)
+    are passed to the shapefile export.
+
+    A partition is written to more than one shapefile if its .shp or .dbf
+    file would exceed the size limit of the format, the manifest lists the
+    names of all shapefiles of a partition.
+    """
+
+    if processes is None:
+        processes = cpu_count()
+    if partitions is None:
+        partitions = processes
+
+    engine = create_engine(url, poolclass=NullPool)
+    Session = scoped_session(sessionmaker(bind=engine))
+
+    try:
+        protocol = FormatsProtocol(Session, resolve(mapped_class), 'wkb_geometry')
+        if by == 'grid':
+            specs = _grid_partitions(protocol, params, partitions)
+        elif by == 'pk':
+            specs = _pk_partitions(protocol, params, partitions)
+        else:
+            raise ValueError("Unknown partitioning %r" % by)
+    finally:
+        Session.remove()
+        engine.dispose()
+
+    directory = mkdtemp()
+
+    try:
+        tasks = [(url, mapped_class, params, spec, directory, kwargs) for spec in specs]
+
+        pool = Pool(processes)
+        try:
+            results = pool.map(_export_partition, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        results = [r for r in results if r is not None]
+
+        members = []
+        for r in results:
+            members.extend(r['files'])
+
+        manifest = {
+            'attrs': params.get("attrs"),
+            'epsg': kwargs.get("epsg", 4326),
+            'by': by,
+            'partitions': results
+        }
+        f = open(os.path.join(directory, "manifest.json"), 'w')
+        f.write(json.dumps(manifest, indent=2))
+        f.close()
+        members.append("manifest.json")
+
+        return protocol._zip_members(directory, members, metadata)
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def _pk_partitions(protocol, params, partitions):
+    """
+    Return the partitions of equal primary key ranges between the smallest
+    and the biggest key of the filtered features.
+    """
+
+    pk = protocol._primary_key()
+    query = protocol.Session.query(func.min(pk), func.max(pk))
+
+    filter = create_filter(JobRequest(params), protocol.mapped_class, 'wkb_geometry')
+    if filter is not None:
+        query = query.filter(filter)
+
+    low, high = query.one()
+    if low is None:
+        return []
+
+    step = int(math.ceil((high - low + 1) / float(partitions)))
+
+    specs = []
+    for i in range(partitions):
+        start = low + i * step
+        if start > high:
+            break
+        specs.append({'index': i + 1, 'range': [start, min(start + step, high + 1)]})
+
+    return specs
+
+def _grid_partitions(protocol, params, partitions):
+    """
+    Return the partitions of a grid of about ``partitions`` cells over the
+    extent of the centroids of the filtered features.
+    """
+
+    x, y = _centroid(protocol)
+    query = protocol.Session.query(func.min(x), func.min(y), func.max(x), func.max(y))
+
+    filter = create_filter(JobRequest(params), protocol.mapped_class, 'wkb_geometry')
+    if filter is not None:
+        query = query.filter(filter)
+
+    minx, miny, maxx, maxy = query.one()
+    if minx is None:
+        return []
+
+    columns = int(math.ceil(math.sqrt(partitions)))
+    rows = int(math.ceil(partitions / float(columns)))
+
+    width = (maxx - minx) / columns
+    height = (maxy - miny) / rows
+
+    specs = []
+    for r in range(rows):
+        for c in range(columns):
+            # The outer cells are open so that no feature is lost to rounding
+            specs.append({'index': len(specs) + 1,
+                          'cell': [None if c == 0 else minx + c * width,
+                                   None if r == 0 else miny + r * height,
+                                   None if c == columns - 1 else minx + (c + 1) * width,
+                                   None if r == rows - 1 else miny + (r + 1) * height]})
+
+    return specs
+
+def _centroid(protocol):
+
+    centroid = func.ST_Centroid(getattr(protocol.mapped_class, 'wkb_geometry'))
+
+    return func.ST_X(centroid), func.ST_Y(centroid)
+
+def _partition_filter(protocol, spec):
+
+    if 'range' in spec:
+        pk = protocol._primary_key()
+        return and_(pk >= spec['range'][0], pk < spec['range'][1])
+
+    x, y = _centroid(protocol)
+    minx, miny, maxx, maxy = spec['cell']
+
+    conditions = []
+    if minx is not None:
+        conditions.append(x >= minx)
+    if miny is not None:
+        conditions.append(y >= miny)
+    if maxx is not None:
+        conditions.append(x < maxx)
+    if maxy is not None:
+        conditions.append(y < maxy)
+
+    return and_(* conditions)
+
+def _export_partition(task):
+    """
+    Write the shapefile of one partition in a worker process and return its
+    manifest entry, or None if the partition is empty.
+    """
+
+    url, mapped_class, params, spec, directory, kwargs = task
+
+    engine = create_engine(url, poolclass=NullPool)
+    Session = scoped_session(sessionmaker(bind=engine))
+
+    try:
+        protocol = FormatsProtocol(Session, resolve(mapped_class), 'wkb_geometry')
+        request = JobRequest(params)
+
+        epsg = kwargs.get("epsg", 4326)
+        query, reproject = protocol._export_query(request, None, epsg, kwargs.get("reproject"))
+        query = query.filter(_partition_filter(protocol, spec))
+
+        if query.first() is None:
+            return None
+
+        rows = [0]
+
+        def progress(count):
+            rows[0] = count
+
+        files = protocol._write_shp_files(request, query, directory, basename="data_%03d" % spec['index'],
+                                          epsg=epsg, reproject=reproject, progress=progress,
+                                          max_size=SHP_MAX_SIZE)
+
+    finally:
+        Session.remove()
+        engine.dispose()
+
+    names = [name[:-len(".shp")] for name in files if name.endswith(".shp")]
+
+    entry = dict(spec)
+    entry.update({'names': names, 'rows': rows[0], 'files': files})
+
+    return entry
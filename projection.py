@@ -0,0 +1,151 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 4:37:12 PM$"
+
+from papyrus_formats.registry import LazyModule
+import threading
+
+# NumPy, Shapely and pyproj are only imported when something is reprojected
+# or looked up, see the registry module
+np = LazyModule("numpy")
+
+# Map of EPSG codes to write the .prj files
+# taken from spatialreference.org
+epsg_code = {
+4326: 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]',
+32648: 'PROJCS["WGS_1984_UTM_Zone_48N",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]],PROJECTION["Transverse_Mercator"],PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",105],PARAMETER["scale_factor",0.9996],PARAMETER["false_easting",500000],PARAMETER["false_northing",0],UNIT["Meter",1]]'
+}
+
+_lock = threading.Lock()
+_transformers = {}
+_wkt = dict(epsg_code)
+
+def get_transformer(source, target):
+    """
+    Return a pyproj transformer from the EPSG code ``source`` to ``target``
+    with x, y (longitude, latitude) axis order. Transformers are expensive
+    to create, so there's one per pair of codes.
+    """
+
+    key = (source, target)
+
+    with _lock:
+        transformer = _transformers.get(key)
+
+    if transformer is None:
+        pyproj = _pyproj()
+        if pyproj is None:
+            raise ImportError("Reprojecting requires pyproj")
+
+        transformer = pyproj.Transformer.from_crs("EPSG:%d" % source, "EPSG:%d" % target, always_xy=True)
+
+        with _lock:
+            transformer = _transformers.setdefault(key, transformer)
+
+    return transformer
+
+def coordinate_transform(source, target):
+    """
+    Return a function reprojecting a NumPy array of [x, y] coordinates from
+    ``source`` to ``target``.
+    """
+
+    transformer = get_transformer(source, target)
+
+    def reproject(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return reproject
+
+def reproject_geometries(geoms, reproject):
+    """
+    Apply the coordinate function ``reproject`` (see ``coordinate_transform``)
+    to an array of geometries, at once on all their coordinates with
+    Shapely 2 and geometry by geometry otherwise.
+    """
+
+    try:
+        from shapely import transform as transform_coordinates
+    except ImportError:
+        transform_coordinates = None
+
+    if transform_coordinates is not None:
+        return transform_coordinates(geoms, reproject)
+
+    from shapely.ops import transform
+
+    def func(x, y, z=None):
+        coords = reproject(np.column_stack([x, y]))
+        return coords[:, 0], coords[:, 1]
+
+    return np.array([None if g is None else transform(func, g) for g in geoms], dtype=object)
+
+def epsg_wkt(code):
+    """
+    Return the ESRI WKT of the EPSG code ``code``, as needed for .prj files.
+    The definitions are looked up with pyproj on first use and kept; the
+    codes in ``epsg_code`` are known without pyproj.
+    """
+
+    with _lock:
+        wkt = _wkt.get(code)
+
+    if wkt is None:
+        pyproj = _pyproj()
+        if pyproj is None:
+            raise KeyError(code)
+
+        wkt = pyproj.CRS.from_epsg(code).to_wkt("WKT1_ESRI")
+
+        with _lock:
+            _wkt[code] = wkt
+
+    return wkt
+
+def epsg_projjson(code):
+    """
+    Return the PROJJSON definition of the EPSG code ``code`` as dictionary,
+    as used in GeoParquet metadata. pyproj before 2.4 can't write PROJJSON,
+    the WKT2 definition is returned as string then.
+    """
+
+    pyproj = _pyproj()
+    if pyproj is None:
+        raise ImportError("The definition of EPSG:%d requires pyproj" % code)
+
+    crs = pyproj.CRS.from_epsg(code)
+
+    if not hasattr(crs, "to_json_dict"):
+        return crs.to_wkt()
+
+    return crs.to_json_dict()
+
+def _pyproj():
+    """
+    Import pyproj, or return None if it isn't installed.
+    """
+
+    try:
+        import pyproj
+    except ImportError:
+        return None
+
+    return pyproj
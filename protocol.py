@@ -19,37 +19,131 @@
 __author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
 __date__ = "$Apr 29, 2013 6:55:21 AM$"
 
+import calendar
+from collections import OrderedDict
+import csv
+import datetime
+from decimal import Decimal
+from email.utils import formatdate
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
 import geojson
+from papyrus_formats.cache import LRUCache
+from papyrus_formats.cache import normalize_params
+from papyrus_formats.cache import request_digest
+from papyrus_formats.instrumentation import NULL_OBSERVER
+from papyrus_formats.pagination import KeysetPage
+from papyrus_formats.pagination import decode_cursor
+from papyrus_formats.projection import coordinate_transform
+# epsg_code used to be defined here
+from papyrus_formats.projection import epsg_code
+from papyrus_formats.projection import epsg_projjson
+from papyrus_formats.projection import epsg_wkt
+from papyrus_formats.registry import LazyModule
+from papyrus_formats.registry import get_format
+from papyrus_formats.registry import import_optional
+from papyrus_formats.registry import is_cached
+from papyrus_formats.registry import register_format
 import logging
+import os
+import re
 from papyrus.protocol import *
-import shapefile
-from shapely.wkb import loads
+import shutil
+import time
 import simplejson as json
+from sqlalchemy import case
+from sqlalchemy import cast
+from sqlalchemy import distinct
 from sqlalchemy import func
+from sqlalchemy import literal
+from sqlalchemy import text
+from sqlalchemy import and_
+from sqlalchemy import not_
 from sqlalchemy import or_
+from sqlalchemy import tuple_
+from sqlalchemy.orm import ColumnProperty
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.types import Boolean
+from sqlalchemy.types import Date
+from sqlalchemy.types import DateTime
+from sqlalchemy.types import Float
+from sqlalchemy.types import Integer
+from sqlalchemy.types import Numeric
+from tempfile import SpooledTemporaryFile
+from tempfile import mkdtemp
 try:
     from StringIO import StringIO
 except ImportError:
     from io import BytesIO as StringIO
 from zipfile import ZIP_DEFLATED
 from zipfile import ZipFile
-import xlwt
-import matplotlib
-matplotlib.use("Agg")
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
-from matplotlib.font_manager import FontProperties
 
 log = logging.getLogger(__name__)
 
-# Map of EPSG codes to write the .prj files
-# taken from spatialreference.org
-epsg_code = {
-4326: 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]',
-32648: 'PROJCS["WGS_1984_UTM_Zone_48N",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]],PROJECTION["Transverse_Mercator"],PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",105],PARAMETER["scale_factor",0.9996],PARAMETER["false_easting",500000],PARAMETER["false_northing",0],UNIT["Meter",1]]'
+def _use_agg():
+    import matplotlib
+    matplotlib.use("Agg")
+
+# The dependencies of single formats are imported on first use, see the
+# registry module
+matplotlib = LazyModule("matplotlib", setup=_use_agg)
+np = LazyModule("numpy")
+plt = LazyModule("matplotlib.pyplot", setup=_use_agg)
+shapefile = LazyModule("shapefile")
+xlwt = LazyModule("xlwt")
+
+# Number of rows fetched per round trip when a result is streamed
+BATCH_SIZE = 1000
+
+# Size in bytes up to which spooled exports are kept in memory before they
+# are rolled over to a file on disk
+SPOOL_MAX_SIZE = 10 * 1024 * 1024
+
+
+# Number of rows per row group of Parquet exports, the cursor batches are
+# collected until a row group is full
+PARQUET_ROW_GROUP_SIZE = 65536
+
+# Row estimate of the query planner below which the estimate count strategy
+# counts exactly
+COUNT_ESTIMATE_MIN = 100000
+
+# Quantiles of the summary statistics of the hist_json format, on PostgreSQL
+HIST_QUANTILES = (0.25, 0.5, 0.75)
+
+# Extent of the vector tiles and the buffer around them in tile units
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+
+# Map of Shapely geometry types to shapefile shape types (the values of
+# shapefile.POINT, shapefile.MULTIPOINT, ... given by the specification)
+shp_shape_types = {
+"Point": 1,
+"MultiPoint": 8,
+"LineString": 3,
+"MultiLineString": 3,
+"Polygon": 5,
+"MultiPolygon": 5
 }
 
+def iter_batches(iterable, size):
+    """
+    Split ``iterable`` into lists of at most ``size`` items.
+    """
+
+    batch = []
+    for i in iterable:
+        batch.append(i)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+# Cache of the built attribute filters per normalized parameter signature
+attr_filter_cache = LRUCache(max_size=1000, sizeof=lambda value: 1)
+
 def logical_attr_filter(request, mapped_class):
     """
     Create an SQLAlchemy filter (a ClauseList object) based
@@ -63,551 +157,2331 @@ def logical_attr_filter(request, mapped_class):
     and the new "filter" parameter
     <ul><li>did=102,103&filter=OR&</li></ul>
 
+    Several values of ``eq`` and ``ne`` are grouped into a single
+    ``IN (...)`` respectively ``NOT IN (...)``, and the values are
+    converted to the Python type of the column.
+
+    Nested groups are created with the ``logical_expr`` parameter, whose
+    operands are the names of the other parameters:
+    <ul><li>logical_expr=and(or(did__eq,name__like),area__gt)</li></ul>
+
+    The filters are cached per parameter signature, so repeated requests
+    don't build them again.
+
     @param request The server request with according parameters
     @param mapped_class
     @return Returns a SQLAlchemy filter according to the request
     """
 
     mapping = {
-	'eq': '__eq__',
-	'ne': '__ne__',
-	'lt': '__lt__',
-	'lte': '__le__',
-	'gt': '__gt__',
-	'gte': '__ge__',
-	'like': 'like',
-	'ilike': 'ilike'
+        'eq': '__eq__',
+        'ne': '__ne__',
+        'lt': '__lt__',
+        'lte': '__le__',
+        'gt': '__gt__',
+        'gte': '__ge__',
+        'like': 'like',
+        'ilike': 'ilike'
     }
 
-    filters = []
-    if 'queryable' in request.params:
-	queryable = request.params['queryable'].split(',')
-	for k in request.params:
-	    if len(request.params[k]) <= 0 or '__' not in k:
-		continue
+    if 'queryable' not in request.params:
+        return None
 
-	    col, op = k.split("__")
+    queryable = request.params['queryable'].split(',')
 
-	    if col not in queryable or op not in mapping.keys():
-		continue
+    # Only the parameters used to build the filter make up the signature
+    signature = [(k, request.params[k]) for k in request.params
+                 if '__' in k or k in ('queryable', 'logical_op', 'logical_expr')]
+    key = (mapped_class, normalize_params(signature, ignore=()))
 
-	    values = request.params[k].split(",")
+    cached = attr_filter_cache.get(key)
+    if cached is not None:
+        return cached[0]
 
-	    for v in values:
-	        column = getattr(mapped_class, col)
-		f = getattr(column, mapping[op])(v)
-                filters.append(f)
+    # The clauses of every parameter
+    clauses = {}
+    for k in request.params:
+        if len(request.params[k]) <= 0 or '__' not in k:
+            continue
 
-    if 'logical_op' in request.params:
-        logicalOp = request.params['logical_op']
-        if logicalOp.lower() == 'and':
-	    return and_(*filters) if len(filters) > 0 else None
-        if logicalOp.lower() == 'or':
-	    return or_(*filters) if len(filters) > 0 else None
-        if logicalOp.lower() == 'not':
-	    return not_(or_(*filters)) if len(filters) > 0 else None
+        col, op = k.split("__", 1)
 
-    return or_(*filters) if len(filters) > 0 else None
+        if col not in queryable or op not in mapping.keys():
+            continue
 
-class FormatsProtocol(Protocol):
+        column = getattr(mapped_class, col)
 
-    def read(self, request, filter=None, id=None, format='geojson', ** kwargs):
-        """
-        Build a query based on the filter or the idenfier, send the query
-        to the database, and return a Feature or a FeatureCollection.
-        """
+        values = request.params[k].split(",")
+        if op not in ('like', 'ilike'):
+            values = [_coerce_value(column, v) for v in values]
 
-        if format == 'geojson':
+        if op == 'eq' and len(values) > 1:
+            clauses[k] = [column.in_(values)]
+        elif op == 'ne' and len(values) > 1:
+            clauses[k] = [~column.in_(values)]
+        else:
+            clauses[k] = [getattr(column, mapping[op])(v) for v in values]
 
-            ret = None
-            if id is not None:
-                o = self.Session.query(self.mapped_class).get(id)
-                if o is None:
-                    abort(404)
-                ret = self._filter_attrs(o.__geo_interface__, request)
-            else:
-                objs = self._query(request, filter)
-                ret = FeatureCollection(
-                                        [self._filter_attrs(o.__geo_interface__, request) \
-                                        for o in objs])
+    if 'logical_expr' in request.params:
+        f = _parse_logical_expr(request.params['logical_expr'], clauses)
+    else:
+        f = _combine_filters(request.params.get('logical_op', 'or'),
+                             [c for k in clauses for c in clauses[k]])
 
-            return geojson.dumps(ret)
+    attr_filter_cache.set(key, (f,))
 
-        if format == 'ext':
-            if id is not None:
-                query = self.Session.query(self.mapped_class).get(id)
-            else:
-                query = self._query(request, None)
-            return self._read_ext(request, query, filter=filter, name_mapping=kwargs['name_mapping'])
+    return f
 
-        if format == 'hist':
-            query = self.Session.query(self.mapped_class)
-            if filter is None:
-                filter = create_filter(request, self.mapped_class, "wkb_geometry")
-            if filter is not None:
-                query.filter(filter)
-            return self._plot_histogram(request, query, categories=kwargs['categories'], filename=kwargs['filename'])
+def _combine_filters(logicalOp, filters):
 
-        if format == 'xls':
+    if len(filters) == 0:
+        return None
 
-            metadata = kwargs.get("metadata", None)
+    if logicalOp.lower() == 'and':
+        return and_(*filters)
+    if logicalOp.lower() == 'not':
+        return not_(or_(*filters))
 
-            query = self._query(request, filter)
-            return self._read_xls(request, query, filter=filter, metadata=metadata)
+    return or_(*filters)
 
-        if format == 'shp':
+def _coerce_value(column, value):
+    """
+    Convert the request parameter ``value`` to the Python type of the
+    mapped attribute ``column``.
+    """
 
-            epsg = kwargs.get("epsg", 4326)
+    try:
+        column_type = column.property.columns[0].type
+    except AttributeError:
+        return value
 
-            metadata = kwargs.get("metadata", None)
+    try:
+        if isinstance(column_type, Boolean):
+            return value.lower() in ('true', 't', 'yes', 'y', 'on', '1')
+        elif isinstance(column_type, Integer):
+            return int(value)
+        elif isinstance(column_type, (Float, Numeric)):
+            return float(value)
+    except ValueError:
+        abort(400)
 
-            if filter is None:
-                filter = create_filter(request, self.mapped_class, 'wkb_geometry')
+    return value
 
-            mapped_attributes = []
-            mapped_attributes.append(functions.wkb(functions.transform(getattr(self.mapped_class, 'wkb_geometry'), epsg)).label("geometry_column"))
-            for attr in request.params.get("attrs").split(","):
-                mapped_attributes.append(getattr(self.mapped_class, attr))
+def _parse_logical_expr(expr, clauses):
+    """
+    Parse a ``logical_expr`` like ``and(or(did__eq,name__like),area__gt)``
+    and return the filter combining the ``clauses`` of the named parameters.
+    Operands without clauses are left out.
+    """
 
-            return self._read_shp(request, self.Session.query(* mapped_attributes).filter(filter), epsg=epsg, metadata=metadata)
+    tokens = re.findall(r"\(|\)|,|[^(),\s]+", expr)
+    position = [0]
 
-    def _read_ext(self, request, query, filter=None, name_mapping=None):
-        """
-        A format suitable for Ext json stores.
-        """
+    def next_token():
+        if position[0] >= len(tokens):
+            abort(400)
+        token = tokens[position[0]]
+        position[0] += 1
+        return token
 
-        output = {}
-        output['totalResults'] = self.count(request, filter)
+    def parse():
+        token = next_token()
 
-        attrs = request.params['attrs'].split(',')
+        if token.lower() in ('and', 'or', 'not') and position[0] < len(tokens) and tokens[position[0]] == '(':
+            position[0] += 1
+            operands = [parse()]
+            separator = next_token()
+            while separator == ',':
+                operands.append(parse())
+                separator = next_token()
+            if separator != ')':
+                abort(400)
 
-        output['metaData'] = {'totalProperty': 'totalResults', 'root': 'rows'}
-        output['metaData']['fields'] = []
+            return _combine_filters(token, [o for o in operands if o is not None])
 
-        output['rows'] = []
+        if token in ('(', ')', ','):
+            abort(400)
 
-        for i in query: #.all():
-            row = {}
-            for k in attrs:
-                value = getattr(i, k)
-                if name_mapping is not None and k in name_mapping:
-                    k = name_mapping[k]
+        # A parameter name, its clauses are ORed as without logical_op
+        operand = clauses.get(token, [])
+        return or_(*operand) if len(operand) > 0 else None
 
-                row[k] = value
+    f = parse()
 
+    if position[0] != len(tokens):
+        abort(400)
 
-                # Check if metadata of current attribute is already declared
-                is_declared = False
-                for f in output['metaData']['fields']:
-                    try:
-                        if f['name'] == k:
-                            is_declared = True
-                    except TypeError:
-                        pass
+    return f
 
-                if not is_declared:
-                    metadataField = {}
-                    metadataField['name'] = k
-                    if isinstance(value, (float)):
-                        metadataField['type'] = 'float'
-                    elif isinstance(value, (int)):
-                        metadataField['type'] = 'int'
-                    else:
-                        metadataField['type'] = 'string'
-                    output['metaData']['fields'].append(metadataField)
+class FormatsProtocol(Protocol):
 
-            # Append the current row to the rows
-            output['rows'].append(row)
+    def __init__(self, Session, mapped_class, * args, ** kwargs):
+        """
+        Accepts the arguments of ``Protocol`` and additionally:
+
+        ``histogram_cache``: a ``LRUCache`` for the rendered histograms
+        ``artifact_cache``: an ``ArtifactCache`` for the exported files
+        ``version_token``: a callable returning a token which changes
+        whenever the data of the mapped class changes
+        ``observer``: an ``Observer`` receiving the timed stages of every
+        read, e.g. a ``LatencyAggregator``
+        ``geometry_cache``: a ``LRUCache`` for the simplified geometries of
+        static layers, e.g. ``LRUCache(100000, sizeof=lambda g: 1)``
+        ``tile_cache``: a ``LRUCache`` for the encoded vector tiles
+        ``count_cache``: a ``LRUCache`` for the total counts of the ext
+        format, e.g. ``LRUCache(10000, sizeof=lambda c: 1)``
+        ``count_ttl``: the number of seconds cached counts are used, 60 by
+        default
+        ``conditional``: whether reads are conditional GETs by default, see
+        ``read``
+        ``updated_attr``: the name of a last modification timestamp attribute
+        of the mapped class, the version of the data for conditional GETs if
+        there's no ``version_token``
+        """
 
-        return json.dumps(output)
+        self.histogram_cache = kwargs.pop("histogram_cache", None)
+        self.version_token = kwargs.pop("version_token", None)
+        self.artifact_cache = kwargs.pop("artifact_cache", None)
+        self.observer = kwargs.pop("observer", NULL_OBSERVER)
+        self.geometry_cache = kwargs.pop("geometry_cache", None)
+        self.tile_cache = kwargs.pop("tile_cache", None)
+        self.count_cache = kwargs.pop("count_cache", None)
+        self.count_ttl = kwargs.pop("count_ttl", 60)
+        self.conditional = kwargs.pop("conditional", False)
+        self.updated_attr = kwargs.pop("updated_attr", None)
 
+        Protocol.__init__(self, Session, mapped_class, * args, ** kwargs)
 
-    """
-    def _plot_histogram(self, request, query, **kwargs):
+    def read(self, request, filter=None, id=None, format='geojson', ** kwargs):
+        """
+        Build a query based on the filter or the idenfier, send the query
+        to the database, and return a Feature or a FeatureCollection, or
+        another ``format`` registered with ``register_format``.
+
+        If the protocol has an artifact cache, the exported files are served
+        from it and only built if they aren't cached yet.
+
+        With ``conditional`` an ETag is derived from the request and the
+        version of the data (the ``version`` keyword argument, the
+        ``version_token`` or the latest ``updated_attr`` and the row count),
+        along with a Last-Modified time if known. If the If-None-Match or
+        If-Modified-Since header of the request matches, the read is aborted
+        with 304 Not Modified before any query runs. Otherwise the headers
+        are set on ``request.response`` if there is one.
+        """
 
-        # Get the requested attribute
-        attr = request.params.get('attrs').split(",")[0]
+        if kwargs.pop("conditional", self.conditional):
+            self._check_conditional(request, filter, id, format, kwargs)
 
-        defaultSide = 480
+        span = self.observer.span("read", format=format)
 
-        try:
-            height = int(request.params.get("height", defaultSide))
-        except ValueError:
-            height = defaultSide
-        try:
-            width = int(request.params.get("width", defaultSide))
-        except ValueError:
-            width = defaultSide
+        with span:
+            if self.artifact_cache is not None and id is None and is_cached(format):
+                key = self._artifact_key(request, filter, format, kwargs)
+                result = self.artifact_cache.get_or_build(key, lambda: self._read(request, filter, id, format, ** kwargs))
+            else:
+                result = self._read(request, filter, id, format, ** kwargs)
 
-        rbreaks = 10
-        if 'breaks' in request.params:
-            rbreaks = int(request.params['breaks'])
+            if span.enabled:
+                span.add(bytes=self._result_size(result))
 
-        rinterface.initr()
+        # Streamed results are measured while they are consumed
+        if span.enabled and self._is_stream(result):
+            return self._observe_stream(result, format)
 
-        r = robjects.r
-        r.library('grDevices')
+        return result
 
-        mappedAttribute = getattr(self.mapped_class, attr)
+    def _check_conditional(self, request, filter, id, format, kwargs):
+        """
+        Abort with 304 Not Modified if the validators of the request match
+        those of the data, or set them on the response otherwise.
+        """
 
-        # Create a temporary file
-        if 'filename' in kwargs:
-            file = open(kwargs['filename'], 'wb')
-        else:
-            # Create a temporary file
-            file = NamedTemporaryFile()
-        r.png(file.name, width=width, height=height)
-        r.par(bg="#F0F0F0", mar=robjects.FloatVector([2.6, 4.1, 3.1, 1.1]))
+        with self.observer.span("validate", format=format):
+            etag, last_modified = self._validators(request, filter, id, format, kwargs)
 
-        bar_color = "#BEBEBE"
+        # Without a data version nothing can be validated
+        if etag is None:
+            return
 
-        # If categories is not none, then the current attribute has categories and
-        # we want to draw a barplot instead of a histogram
-        if "categories" in kwargs and kwargs['categories'] is not None:
-            categories = kwargs['categories']
+        headers = [('ETag', etag)]
+        if last_modified is not None:
+            headers.append(('Last-Modified', formatdate(last_modified, usegmt=True)))
 
-            names = []
-            v = []
-            #for i in self.Session.query(func.count(mappedAttribute)).filter(mappedAttribute.in_(keys)).group_by(mappedAttribute):
-            for a, count in query.from_self(mappedAttribute, func.count(mappedAttribute)).filter(mappedAttribute.in_(categories.keys())).group_by(mappedAttribute):
-                v.append(int(count))
-                names.append(categories[unicode(a)].encode('UTF-8'))
-            x = robjects.IntVector(v)
+        if self._not_modified(request, etag, last_modified):
+            abort(304, headers=headers)
 
-            x.names = robjects.StrVector(names)
-            r.barplot(x, col=bar_color, xlab=str(), ylab=str(), main=str(), ** {"names.arg": robjects.StrVector(names)})
-            #r.par(bg="#F0F0F0", mar=robjects.FloatVector([1.5, 1.5, 1.5, 1.5]))
-            #r.pie(x, labels=robjects.StrVector(names), clockwise=True)
+        response = getattr(request, "response", None)
+        if response is not None:
+            for k, v in headers:
+                response.headers[k] = v
 
-        # Handle quantitative data
-        else:
+    def _validators(self, request, filter, id, format, kwargs):
+        """
+        Return the ETag of a read and the last modification time of the data
+        as Unix timestamp (or None), or (None, None) if there's no version of
+        the data.
+        """
 
-            v = []
-            for i in query.all():
-                v.append(getattr(i, attr))
+        last_modified = None
+        version = self._data_version(** kwargs)
 
-            x = robjects.FloatVector(v)
+        if version is None and self.updated_attr is not None:
+            # Deleted rows don't change the latest timestamp, but the count
+            updated, count = self.Session.query(func.max(getattr(self.mapped_class, self.updated_attr)), func.count()).one()
+            version = [updated, count]
+            if isinstance(updated, datetime.datetime):
+                last_modified = calendar.timegm(updated.utctimetuple())
+            elif isinstance(updated, datetime.date):
+                last_modified = calendar.timegm(updated.timetuple())
 
-            r.hist(x, col=bar_color, breaks=rbreaks, ylab=str(), xlab=str(), main=str())
+        if version is None:
+            return None, None
 
-        # Finish drawing
-        r('dev.off()')
+        metadata = kwargs.get("metadata")
+        if metadata is not None:
+            metadata = [metadata.get_headers(), metadata.get_rows(), metadata.get_address()]
 
-        f = open(file.name, 'r')
+        # The options which change the output, callbacks aside
+        options = dict((k, v) for k, v in kwargs.items() if k not in ("metadata", "progress", "version") and not callable(v))
 
-        return f"""
+        etag = '"%s"' % request_digest(self.mapped_class.__name__,
+                                       format,
+                                       id,
+                                       normalize_params(request.params),
+                                       self._filter_key(filter),
+                                       options,
+                                       metadata,
+                                       version)
 
+        return etag, last_modified
 
-    def _plot_histogram(self, request, query, ** kwargs):
+    def _not_modified(self, request, etag, last_modified):
         """
-        Alternative implementation with matplotlib instead of R
+        Return whether the If-None-Match header of the request matches
+        ``etag``, or if there's none, whether the data wasn't modified since
+        the If-Modified-Since header.
         """
 
-        # Get the first requested attribute
-        attr = request.params.get('attrs').split(",")[0]
+        headers = getattr(request, "headers", None)
+        if headers is None:
+            return False
 
-        # Set a default value for the image size in pixel
-        defaultSide = 480.0
-        # Set the dpi
-        dpi = 96.0
+        if_none_match = headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(",")]
+            return "*" in tags or etag in tags or "W/" + etag in tags
 
-        try:
-            height = float(request.params.get("height", defaultSide))
-        except ValueError:
-            height = defaultSide
-        try:
-            width = float(request.params.get("width", defaultSide))
-        except ValueError:
-            width = defaultSide
+        if_modified_since = headers.get("If-Modified-Since")
+        if if_modified_since is not None and last_modified is not None:
+            since = parsedate_tz(if_modified_since)
+            return since is not None and last_modified <= mktime_tz(since)
 
-        mappedAttribute = getattr(self.mapped_class, attr)
+        return False
 
-        fig = plt.figure(figsize=(width / dpi, height / dpi))
-        ax = fig.add_subplot(111)
+    def _is_stream(self, result):
 
-        # Set fontProperties
-        fontProperties = FontProperties(family="sans-serif", size='x-small')
+        return not isinstance(result, basestring) and not hasattr(result, "read") and hasattr(result, "__iter__")
 
-        # Set smaller fonts
-        [i.set_fontproperties(fontProperties) for i in ax.get_yticklabels()]
-        [j.set_fontproperties(fontProperties) for j in ax.get_xticklabels()]
+    def _result_size(self, result):
+        """
+        Return the size in bytes of a string or file-like result, 0 for
+        streamed results.
+        """
 
-        # If categories is not none, then the current attribute has categories and
-        # we want to draw a barplot instead of a histogram
-        if kwargs["categories"] is not None:
+        if isinstance(result, basestring):
+            return len(result)
 
-            categories = kwargs["categories"]
+        if hasattr(result, "read"):
+            position = result.tell()
+            result.seek(0, os.SEEK_END)
+            size = result.tell()
+            result.seek(position)
+            return size
 
-            v = []
-            names = []
-            for a, count in query.from_self(mappedAttribute, func.count(mappedAttribute)).filter(mappedAttribute.in_(categories.keys())).group_by(mappedAttribute):
-                v.append(int(count))
-                names.append(categories[unicode(a)].encode('UTF-8'))
+        return 0
 
-            N = len(v)
+    def _observe_stream(self, chunks, format):
 
-            ind = range(N)
+        with self.observer.span("stream", format=format) as span:
+            for chunk in chunks:
+                span.add(bytes=len(chunk), chunks=1)
+                yield chunk
 
-            # the histogram of the data
-            ax.bar(np.array(ind) + 0.1, v, width=0.8, color=kwargs.get("color"))
+    def _read(self, request, filter=None, id=None, format='geojson', ** kwargs):
+        """
+        Read ``format`` with the handler registered for it, see
+        ``papyrus_formats.registry``. Unknown formats return None.
+        """
 
-            # hist uses np.histogram under the hood to create 'n' and 'bins'.
-            # np.histogram returns the bin edges, so there will be 50 probability
-            # density values in n, 51 bin edges in bins and 50 patches.  To get
-            # everything lined up, we'll compute the bin centers
-            ax.set_xticks(np.arange(len(v)) + 0.5)
-            ax.set_xticklabels(names)
+        handler = get_format(format)
+        if handler is None:
+            return None
 
-        else:
+        return handler(self, request, filter, id, format=format, ** kwargs)
 
-            # Get the number of distinct values
-            distinct_value = query.from_self(mappedAttribute).distinct(mappedAttribute).count()
+    def _format_geojson(self, request, filter=None, id=None, format='geojson', ** kwargs):
 
-            # Limit the breaks to 100
-            if distinct_value > 100:
-                distinct_value = 100
-            # In case of less distinct values, limit the number of breaks
-            elif distinct_value > 20 and distinct_value < 100:
-                distinct_value = int(distinct_value / 2)
+        # Simplification tolerance and coordinate precision
+        tolerance, precision = self._simplification(request)
 
-            v = [i for i, in query.from_self(mappedAttribute).all()]
+        # Resume after the cursor of the previous page
+        keyset = id is None and kwargs.get("keyset", False)
 
-            # the histogram of the data
-            n, bins, patches = ax.hist(v, bins=distinct_value, facecolor=kwargs.get("color"), alpha=0.75)
+        # Let the database serialize the geometries
+        if id is None and kwargs.get("engine") == 'db':
+            return self._read_geojson_db(request, filter, stream=kwargs.get("stream", False), tolerance=tolerance, precision=precision, keyset=keyset)
 
-            """
-            n, bins = np.histogram(v, distinct_value)
+        simplification = None
+        if tolerance is not None or precision is not None:
+            simplification = (tolerance, precision, self._data_version(** kwargs))
 
-            # get the corners of the rectangles for the histogram
-            left = np.array(bins[:-1])
-            right = np.array(bins[1:])
-            bottom = np.zeros(len(left))
-            top = bottom + n
-            nrects = len(left)
+        # Stream the features instead of building the collection in memory
+        if id is None and kwargs.get("stream", False):
+            query = self._build_query(request, filter, keyset=keyset)
+            return self._stream_geojson(request, query, batch_size=kwargs.get("batch_size", BATCH_SIZE), simplification=simplification,
+                                        page=self._keyset_page(request) if keyset else None)
 
-            nverts = nrects*(1+3+1)
-            verts = np.zeros((nverts, 2))
-            codes = np.ones(nverts, int) * matplotlib.path.Path.LINETO
-            codes[0::5] = matplotlib.path.Path.MOVETO
-            codes[4::5] = matplotlib.path.Path.CLOSEPOLY
-            verts[0::5,0] = left
-            verts[0::5,1] = bottom
-            verts[1::5,0] = left
-            verts[1::5,1] = top
-            verts[2::5,0] = right
-            verts[2::5,1] = top
-            verts[3::5,0] = right
-            verts[3::5,1] = bottom
+        ret = None
+        if id is not None:
+            o = self.Session.query(self.mapped_class).get(id)
+            if o is None:
+                abort(404)
+            ret = self._geo_feature(o, request, simplification)
+        else:
+            # Query and hydrate the ORM objects
+            page = None
+            with self.observer.span("query", format=format) as span:
+                if keyset:
+                    page = self._keyset_page(request)
+                    objs = list(page.rows(self._build_query(request, filter, keyset=True)))
+                else:
+                    objs = self._query(request, filter)
+                span.add(rows=len(objs))
+
+            with self.observer.span("features", format=format):
+                ret = FeatureCollection(
+                                        [self._geo_feature(o, request, simplification) \
+                                        for o in objs])
+                if page is not None:
+                    ret['nextCursor'] = page.next_cursor()
 
-            barpath = matplotlib.path.Path(verts, codes)
-            patch = matplotlib.patches.PathPatch(barpath, facecolor=kwargs.get("color"), alpha=0.75)
-            ax.add_patch(patch)
+        with self.observer.span("serialize", format=format):
+            return geojson.dumps(ret)
 
-            ax.set_xlim(0, right[-1])
-            ax.set_ylim(bottom.min(), top.max())
-            """
+    def _format_ext(self, request, filter=None, id=None, format='ext', ** kwargs):
+
+        # Query only the requested columns instead of the whole entities
+        columns = [getattr(self.mapped_class, a) for a in request.params['attrs'].split(',')]
+        count = kwargs.get("count", "exact")
+        keyset = id is None and kwargs.get("keyset", False)
+        if keyset and 'cursor' in request.params and count == "window":
+            # The window would only count the rows after the cursor
+            count = "exact"
+        if id is not None:
+            query = self.Session.query(* columns).filter(self._primary_key() == id)
+            count = "exact"
+        else:
+            if count == "window":
+                # Fetch the total with every row of the page
+                columns.append(func.count().over().label("total_count"))
+            query = self._build_query(request, filter, entities=columns, keyset=keyset)
+        return self._read_ext(request, query, filter=filter, name_mapping=kwargs.get('name_mapping'),
+                              stream=kwargs.get("stream", False), count=count, version=self._data_version(** kwargs),
+                              page=self._keyset_page(request) if keyset else None)
+
+    def _format_hist(self, request, filter=None, id=None, format='hist', ** kwargs):
+
+        # Options of the plot, they are part of the cache key too
+        plot_kwargs = {'categories': kwargs.get('categories'), 'filename': kwargs.get('filename')}
+        for k in ('color', 'xlabel', 'ylabel'):
+            if k in kwargs:
+                plot_kwargs[k] = kwargs[k]
+
+        key = None
+        if self.histogram_cache is not None:
+            version = self._data_version(** kwargs)
+            key = self._histogram_key(request, filter, plot_kwargs)
+            png = self.histogram_cache.get(key, version)
+            if png is not None:
+                if plot_kwargs['filename'] is not None:
+                    self._write_file(plot_kwargs['filename'], png)
+                return StringIO(png)
+
+        query = self.Session.query(self.mapped_class)
+        if filter is None:
+            filter = create_filter(request, self.mapped_class, "wkb_geometry")
+        if filter is not None:
+            query = query.filter(filter)
+        file = self._plot_histogram(request, query, ** plot_kwargs)
+
+        if key is not None:
+            self.histogram_cache.set(key, file.getvalue(), version)
 
-            # hist uses np.histogram under the hood to create 'n' and 'bins'.
-            # np.histogram returns the bin edges, so there will be 50 probability
-            # density values in n, 51 bin edges in bins and 50 patches.  To get
-            # everything lined up, we'll compute the bin centers
+        return file
 
-        if 'xlabel' in kwargs:
-            ax.set_xlabel(kwargs['xlabel'], fontproperties=fontProperties)
-        if 'ylabel' in kwargs:
-            ax.set_ylabel(kwargs['ylabel'], fontproperties=fontProperties)
+    def _format_hist_json(self, request, filter=None, id=None, format='hist_json', ** kwargs):
 
+        if filter is None:
+            filter = create_filter(request, self.mapped_class, "wkb_geometry")
 
-        ax.grid(True)
+        stats = kwargs.get("stats", asbool(request.params.get("stats", False)))
 
-        if "filename" in kwargs:
-            file = open("filename", 'wb')
-            fig.savefig(kwargs["filename"], dpi=dpi, format="png")
-        else:
-            file = StringIO()
-            fig.savefig(file, dpi=dpi, format="png")
+        return self._read_hist_json(request, filter, categories=kwargs.get("categories"), stats=stats)
 
-        file.seek(0)  # rewind the data
+    def _format_mvt(self, request, filter=None, id=None, format='mvt', ** kwargs):
 
-        return file
+        return self._read_mvt(request, filter, ** kwargs)
 
-    def _read_xls(self, request, query, ** kwargs):
+    def _format_xls(self, request, filter=None, id=None, format='xls', ** kwargs):
 
-        requested_attrs = request.params.get("attrs").split(",")
+        metadata = kwargs.get("metadata", None)
 
-        workbook = xlwt.Workbook(encoding='utf-8')
-        sheet = workbook.add_sheet("data")
-        
-        row = 0
-        column = 0
-        for a in requested_attrs:
-            sheet.write(row, column, a, xlwt.easyxf('font: bold true; borders: bottom THIN;'))
-            column += 1
+        with self.observer.span("query", format=format) as span:
+            query = self._query(request, filter)
+            span.add(rows=len(query))
 
-        row += 1
-        
-        for i in query: #.all():
-            column = 0
-            for a in requested_attrs:
-                sheet.write(row, column, getattr(i, a))
-                column += 1
+        return self._read_xls(request, query, filter=filter, metadata=metadata, progress=kwargs.get("progress"))
 
-            row += 1
-        
-        if kwargs.get("metadata", None) is not None:
+    def _format_xlsx(self, request, filter=None, id=None, format='xlsx', ** kwargs):
 
-            self._write_metadata(workbook, kwargs.get("metadata"))
-            # Write the workbook to a file-like object
-            xls = StringIO()
-            # Save the workbook to the memory object
-            workbook.save(xls)
+        metadata = kwargs.get("metadata", None)
 
-        # Create a file-like object
-        s = StringIO()
-        # Save the workbook to the memory object
-        workbook.save(s)
-        return s
+        columns = [getattr(self.mapped_class, a) for a in request.params.get("attrs").split(",")]
+        query = self._build_query(request, filter, entities=columns)
+        return self._read_xlsx(request, query, metadata=metadata, progress=kwargs.get("progress"))
 
-    def _read_shp(self, request, query, ** kwargs):
+    def _format_csv(self, request, filter=None, id=None, format='csv', ** kwargs):
 
-        requested_attrs = request.params.get("attrs").split(",")
+        columns = [getattr(self.mapped_class, a) for a in request.params.get("attrs").split(",")]
+        query = self._build_query(request, filter, entities=columns)
+        return self._read_csv(request, query, progress=kwargs.get("progress"))
 
-        # Get the first feature to guess the datatype
-        first_record = query.first()
+    def _format_columnar(self, request, filter=None, id=None, format='parquet', ** kwargs):
 
-        # Create geometry from AsBinary query
-        first_geom = loads(str(getattr(first_record, 'geometry_column')))
+        epsg = kwargs.get("epsg", 4326)
 
-        log.debug("Geometry type is %s" % first_geom.geom_type)
+        query, reproject = self._export_query(request, filter, epsg, kwargs.get("reproject"))
 
-        w = shapefile.Writer(shapefile.POLYGON)
-        if first_geom.geom_type == "Point":
-            w = shapefile.Writer(shapefile.POINT)
-        elif first_geom.geom_type == "LineString":
-            w = shapefile.Writer(shapefile.POLYLINE)
+        return self._read_columnar(request, query, format=format, epsg=epsg, metadata=kwargs.get("metadata"), progress=kwargs.get("progress"), reproject=reproject)
 
-        w.autoBalance = 1
+    def _format_fgb(self, request, filter=None, id=None, format='fgb', ** kwargs):
 
-        # Loop all requested attributes
-        for attr in requested_attrs:
+        epsg = kwargs.get("epsg", 4326)
 
-            first_value = getattr(first_record, attr)
+        query, reproject = self._export_query(request, filter, epsg, kwargs.get("reproject"))
 
-            # Guess the datatype
-            if isinstance(first_value, int):
-                w.field(str(attr), 'N', 40)
-            elif isinstance(first_value, float):
-                w.field(str(attr), 'N', 40, 10)
-            else:
-                w.field(str(attr), 'C', 40)
+        return self._read_fgb(request, query, epsg=epsg, progress=kwargs.get("progress"), reproject=reproject)
 
-        # Now query all features
-        for i in query.all():
+    def _format_shp(self, request, filter=None, id=None, format='shp', ** kwargs):
 
-            # Create geometry from self.mapped_class
-            #g = loads(str(getattr(i, 'geometry_column').geom_wkb))
-            # Create geometry from AsBinary query
-            g = loads(str(getattr(i, 'geometry_column')))
+        epsg = kwargs.get("epsg", 4326)
 
-            # Handle point geometries
-            if g.geom_type == "Point":
+        metadata = kwargs.get("metadata", None)
 
-                w.point(g.coords[0][0], g.coords[0][1])
+        query, reproject = self._export_query(request, filter, epsg, kwargs.get("reproject"))
 
-            # Handle linestring geometries
-            if g.geom_type == "LineString":
+        if kwargs.get("spool", False):
+            return self._read_shp_spooled(request, query, epsg=epsg, metadata=metadata, progress=kwargs.get("progress"), reproject=reproject)
 
-                point_list = []
+        return self._read_shp(request, query, epsg=epsg, metadata=metadata, reproject=reproject)
 
-                for p in g.coords:
-                    point_list.append([p[0], p[1]])
+    def _artifact_key(self, request, filter, format, kwargs):
+        """
+        Return the artifact cache key of an export: a digest of the mapped
+        class, the format, the normalized request parameters, the filter and
+        the export options along with the data version.
+        """
 
-                w.line(parts=[point_list])
+        metadata = kwargs.get("metadata")
+        if metadata is not None:
+            metadata = [metadata.get_headers(), metadata.get_rows(), metadata.get_address()]
 
-            # Handle polygon geometries
-            if g.geom_type == "Polygon":
+        return request_digest(self.mapped_class.__name__,
+                              format,
+                              normalize_params(request.params),
+                              self._filter_key(filter),
+                              kwargs.get("epsg"),
+                              metadata,
+                              self._data_version(** kwargs))
 
-                ring_list = []
+    def _export_query(self, request, filter, epsg, reproject=None):
+        """
+        Return the query of the file exports, selecting the geometry as WKB
+        labeled ``geometry_column`` and the requested ``attrs``, along with
+        the coordinate function reprojecting the geometries to ``epsg``.
 
-                point_list = []
+        The database transforms the geometries unless ``reproject`` is
+        'client', in which case the returned function reprojects them in
+        batches in the application.
+        """
 
-                for j in g.exterior.coords:
-                    point_list.append([j[0], j[1]])
+        if filter is None:
+            filter = create_filter(request, self.mapped_class, 'wkb_geometry')
 
-                ring_list.append(point_list)
+        geometry = getattr(self.mapped_class, 'wkb_geometry')
 
-                for interior in g.interiors:
+        transform = None
+        mapped_attributes = []
+        if reproject == 'client':
+            # Reproject the coordinates in batches here instead of
+            # letting the database transform every vertex
+            source = self._geometry_srid()
+            if source != epsg:
+                transform = coordinate_transform(source, epsg)
+            mapped_attributes.append(functions.wkb(geometry).label("geometry_column"))
+        else:
+            mapped_attributes.append(functions.wkb(functions.transform(geometry, epsg)).label("geometry_column"))
+        for attr in request.params.get("attrs").split(","):
+            mapped_attributes.append(getattr(self.mapped_class, attr))
 
-                    point_list = []
+        return self.Session.query(* mapped_attributes).filter(filter), transform
 
-                    for k in interior.coords:
-                        point_list.append([k[0], k[1]])
+    def _filter_key(self, filter):
+        """
+        Return the SQL and the parameter values of ``filter`` as part of a
+        cache key.
+        """
 
-                    ring_list.append(point_list)
+        if filter is None:
+            return None
 
-                w.poly(shapeType=shapefile.POLYGON, parts=ring_list)
+        compiled = filter.compile()
 
-            values = []
-            for v in requested_attrs:
-                try:
-                    values.append(str(getattr(i, v)))
-                except UnicodeEncodeError:
-                    values.append(str(getattr(i, v).encode("UTF-8")))
+        return (str(compiled), tuple(sorted(compiled.params.items())))
 
-            w.record(* values)
+    def _build_query(self, request, filter=None, entities=None, keyset=False):
+        """
+        Build the same query as ``_query`` but return the query object itself
+        instead of a list, so the rows can be fetched in batches.
+
+        With ``keyset`` the rows are ordered by the ``order_by`` column and
+        the primary key, and instead of skipping ``offset`` rows the query
+        resumes after the keyset values of the ``cursor`` parameter. Queries
+        of columns (``entities``) select the keyset values too, labeled
+        ``keyset_0``, ``keyset_1``, ... The ``order_by`` column should not be
+        nullable.
+        """
 
-        # Create the required files and fill them
-        shp = StringIO()
-        shx = StringIO()
-        dbf = StringIO()
-        cpg = StringIO()
-        prj = StringIO()
-        w.saveShp(shp)
-        w.saveShx(shx)
-        w.saveDbf(dbf)
-        cpg.write("UTF-8")
-        prj.write(epsg_code[kwargs.get("epsg", 4326)])
+        limit = None
+        offset = None
+        if 'maxfeatures' in request.params:
+            limit = int(request.params['maxfeatures'])
+        if 'limit' in request.params:
+            limit = int(request.params['limit'])
+        if 'offset' in request.params:
+            offset = int(request.params['offset'])
 
-        # Create a memory file-like deflated zip file
-        s = StringIO()
-        f = ZipFile(s, 'w', ZIP_DEFLATED)
-        f.writestr("data.shp", shp.getvalue())
-        f.writestr("data.dbf", dbf.getvalue())
-        f.writestr("data.shx", shx.getvalue())
-        f.writestr("data.cpg", cpg.getvalue())
-        f.writestr("data.prj", prj.getvalue())
+        if filter is None:
+            filter = create_filter(request, self.mapped_class, 'wkb_geometry')
 
+        # Rows of columns instead of mapped objects
+        columns_query = entities is not None
 
-        if kwargs.get("metadata") is not None:
-            wb = xlwt.Workbook(encoding='utf-8')
+        if entities is None:
+            entities = [self.mapped_class]
 
-            self._write_metadata(wb, kwargs.get("metadata"))
-            # Write the workbook to a file-like object
-            xls = StringIO()
-            # Save the workbook to the memory object
-            wb.save(xls)
+        query = self.Session.query(* entities)
+        if filter is not None:
+            query = query.filter(filter)
 
-            f.writestr("metadata.xls", xls.getvalue())
+        if keyset:
+            columns, descending = self._keyset_columns(request)
 
-        # Close the zip file
-        f.close()
+            if columns_query:
+                query = query.add_columns(* [c.label("keyset_%d" % i) for i, c in enumerate(columns)])
 
-        # And return the content
-        return s
+            if 'cursor' in request.params:
+                try:
+                    values = decode_cursor(request.params['cursor'])
+                except ValueError:
+                    abort(400)
+                if len(values) != len(columns):
+                    abort(400)
+
+                key = tuple_(* columns)
+                bound = tuple_(* [literal(v) for v in values])
+                query = query.filter(key < bound if descending else key > bound)
+
+            query = query.order_by(* [c.desc() if descending else c for c in columns])
+
+            return query.limit(limit)
+
+        if 'order_by' in request.params:
+            column = getattr(self.mapped_class, request.params['order_by'])
+            if request.params.get('dir', 'ASC').upper() == 'DESC':
+                column = column.desc()
+            query = query.order_by(column)
+
+        return query.limit(limit).offset(offset)
+
+    def _keyset_columns(self, request):
+        """
+        Return the columns of the keyset, the ``order_by`` column if given
+        and the primary key, and whether they are sorted descending.
+        """
+
+        columns = []
+        if 'order_by' in request.params:
+            columns.append(getattr(self.mapped_class, request.params['order_by']))
+        columns.append(self._primary_key())
+
+        return columns, request.params.get('dir', 'ASC').upper() == 'DESC'
+
+    def _keyset_page(self, request):
+        """
+        Return the ``KeysetPage`` tracking the rows of a keyset paginated
+        query built by ``_build_query``.
+        """
+
+        names = []
+        if 'order_by' in request.params:
+            names.append(request.params['order_by'])
+        names.append(class_mapper(self.mapped_class).get_property_by_column(self._primary_key()).key)
+
+        def keys(row):
+            # Rows of columns carry the labeled keyset values
+            if hasattr(row, "keyset_0"):
+                return [getattr(row, "keyset_%d" % i) for i in range(len(names))]
+            return [getattr(row, n) for n in names]
+
+        limit = request.params.get('limit', request.params.get('maxfeatures'))
+
+        return KeysetPage(keys, int(limit) if limit is not None else None)
+
+    def _stream_geojson(self, request, query, batch_size=BATCH_SIZE, simplification=None, page=None):
+        """
+        Return an iterator of JSON chunks forming a FeatureCollection: the
+        header, one feature per chunk and the footer. Rows are fetched through
+        a server-side cursor in batches of ``batch_size``, so the iterator can
+        be used directly as a WSGI app_iter.
+
+        The session must stay open until the iterator is exhausted.
+        """
+
+        query = query.execution_options(stream_results=True).yield_per(batch_size)
+        if page is not None:
+            query = page.rows(query)
+
+        return self._iter_feature_collection((geojson.dumps(self._geo_feature(o, request, simplification)) \
+                                             for o in query), page)
+
+    def _simplification(self, request):
+        """
+        Return the simplification tolerance and the coordinate precision
+        requested with the ``simplify`` (a tolerance in the units of the
+        geometry column), ``zoom`` (a tile zoom level, the tolerance is the
+        size of a pixel) and ``precision`` (decimal places) parameters.
+        """
+
+        tolerance = None
+        precision = None
+
+        try:
+            if 'simplify' in request.params:
+                tolerance = float(request.params['simplify'])
+            elif 'zoom' in request.params:
+                from papyrus_formats.geometry import zoom_tolerance
+                tolerance = zoom_tolerance(int(request.params['zoom']), geographic=self._geometry_srid() == 4326)
+
+            if 'precision' in request.params:
+                precision = int(request.params['precision'])
+        except ValueError:
+            abort(400)
+
+        if tolerance is not None and tolerance <= 0:
+            tolerance = None
+
+        return tolerance, precision
+
+    def _geometry_srid(self):
+        """
+        Return the SRID of the geometry column, 4326 if it is unknown.
+        """
+
+        try:
+            srid = getattr(self.mapped_class, 'wkb_geometry').property.columns[0].type.srid
+        except AttributeError:
+            return 4326
+
+        if srid is None or srid < 0:
+            return 4326
+
+        return srid
+
+    def _geometry_type(self):
+        """
+        Return the declared type of the geometry column like 'POINT' or
+        'GEOMETRY', None if it is unknown.
+        """
+
+        try:
+            type = getattr(self.mapped_class, 'wkb_geometry').property.columns[0].type
+        except AttributeError:
+            return None
+
+        # GeoAlchemy 2 types have a geometry_type, GeoAlchemy types a name
+        name = getattr(type, "geometry_type", None) or getattr(type, "name", None)
+        if not hasattr(name, "upper"):
+            return None
+
+        return name.upper()
+
+    def _geo_feature(self, o, request, simplification=None):
+        """
+        Return the filtered feature of the object ``o``, with its geometry
+        simplified and quantized according to ``simplification``, a tuple of
+        the tolerance, the precision and the data version.
+        """
+
+        feature = self._filter_attrs(o.__geo_interface__, request)
+
+        if simplification is None or feature.geometry is None:
+            return feature
+
+        tolerance, precision, version = simplification
+
+        from papyrus_formats.geometry import quantize_geometry
+        from papyrus_formats.geometry import simplify_geometry
+        from shapely.geometry import mapping
+        from shapely.geometry import shape
+
+        key = None
+        if self.geometry_cache is not None and feature.id is not None:
+            key = (self.mapped_class.__name__, feature.id, tolerance, precision)
+            geometry = self.geometry_cache.get(key, version)
+            if geometry is not None:
+                feature.geometry = geometry
+                return feature
+
+        g = shape(feature.geometry)
+        if tolerance is not None:
+            g = simplify_geometry(g, tolerance)
+        if precision is not None:
+            g = quantize_geometry(g, precision)
+
+        feature.geometry = mapping(g)
+
+        if key is not None:
+            self.geometry_cache.set(key, feature.geometry, version)
+
+        return feature
+
+    def _iter_feature_collection(self, features, page=None):
+        """
+        Return an iterator of JSON chunks of a FeatureCollection with the
+        already serialized ``features``. With a ``KeysetPage`` the cursor of
+        the next page is added as ``nextCursor``.
+        """
+
+        yield '{"type": "FeatureCollection", "features": ['
+
+        separator = ''
+        for feature in features:
+            yield separator + feature
+            separator = ', '
+
+        if page is not None:
+            yield '], "nextCursor": %s}' % json.dumps(page.next_cursor())
+        else:
+            yield ']}'
+
+    def _read_geojson_db(self, request, filter=None, stream=False, tolerance=None, precision=None, keyset=False):
+        """
+        Read a FeatureCollection whose geometries are serialized to GeoJSON
+        by the database (``ST_AsGeoJSON``, ``AsGeoJSON`` on SpatiaLite).
+
+        Only the primary key, the requested ``attrs`` (all attributes by
+        default) and the serialized geometry are selected, and the geometry
+        fragments are put into the output without being parsed again. With
+        ``stream`` an iterator of JSON chunks is returned.
+
+        The geometries are simplified with ``tolerance`` and their coordinates
+        rounded to ``precision`` decimal places in the query itself.
+        """
+
+        if 'attrs' in request.params:
+            attrs = request.params['attrs'].split(',')
+        else:
+            attrs = [p.key for p in class_mapper(self.mapped_class).iterate_properties
+                     if isinstance(p, ColumnProperty) and p.key != 'wkb_geometry' and p.columns[0] is not self._primary_key()]
+
+        columns = [self._primary_key()] + [getattr(self.mapped_class, a) for a in attrs]
+
+        with_geometry = not asbool(request.params.get('no_geom', False))
+        if with_geometry:
+            geometry = getattr(self.mapped_class, 'wkb_geometry')
+            if tolerance is not None:
+                geometry = self._simplify_sql(geometry, tolerance)
+            columns.append(self._as_geojson(geometry, precision))
+
+        query = self._build_query(request, filter, entities=columns, keyset=keyset)
+        query = query.execution_options(stream_results=True).yield_per(BATCH_SIZE)
+
+        page = None
+        if keyset:
+            page = self._keyset_page(request)
+            query = page.rows(query)
+
+        chunks = self._iter_feature_collection((self._geojson_db_feature(row, attrs, with_geometry) for row in query), page)
+
+        if stream:
+            return chunks
+
+        return ''.join(chunks)
+
+    def _geojson_db_feature(self, row, attrs, with_geometry):
+
+        geometry = 'null'
+        if with_geometry and row[len(attrs) + 1] is not None:
+            geometry = row[len(attrs) + 1]
+
+        properties = dict(zip(attrs, row[1:len(attrs) + 1]))
+
+        return '{"type": "Feature", "id": %s, "geometry": %s, "properties": %s}' % (json.dumps(row[0]), geometry, json.dumps(properties))
+
+    def _as_geojson(self, geometry, precision=None):
+        """
+        Return the SQL expression serializing ``geometry`` to GeoJSON, with
+        at most ``precision`` decimal places if given.
+        """
+
+        args = [geometry]
+        if precision is not None:
+            args.append(precision)
+
+        if self._dialect_name() == 'sqlite':
+            return func.AsGeoJSON(* args)
+
+        return func.ST_AsGeoJSON(* args)
+
+    def _simplify_sql(self, geometry, tolerance):
+        """
+        Return the SQL expression simplifying ``geometry`` while preserving
+        its topology.
+        """
+
+        if self._dialect_name() == 'sqlite':
+            return func.SimplifyPreserveTopology(geometry, tolerance)
+
+        return func.ST_SimplifyPreserveTopology(geometry, tolerance)
+
+    def _dialect_name(self):
+
+        return self.Session.get_bind(class_mapper(self.mapped_class)).dialect.name
+
+    def _primary_key(self):
+        """
+        Return the primary key column of the mapped class.
+        """
+
+        return class_mapper(self.mapped_class).primary_key[0]
+
+    def _read_ext(self, request, query, filter=None, name_mapping=None, stream=False, count="exact", version=None, page=None):
+        """
+        A format suitable for Ext json stores.
+
+        ``query`` must select the requested attributes as columns, in the
+        order of the ``attrs`` parameter. The field metadata is derived once
+        from the column types of the mapped class, and the rows are
+        serialized in a single pass. With ``stream`` an iterator of JSON
+        chunks is returned instead of a string.
+
+        ``count`` is the strategy for the total number of results, reported
+        as ``countStrategy`` in the metadata:
+
+        'exact': count the filtered rows
+        'cached': count exactly, but reuse the count of the same filter for
+        ``count_ttl`` seconds (needs a ``count_cache``)
+        'estimate': use the row estimate of the PostgreSQL planner, unless it
+        is below ``COUNT_ESTIMATE_MIN`` rows
+        'window': ``query`` selects the total as ``total_count`` column,
+        it's written after the rows
+
+        With a ``KeysetPage`` the cursor of the next page is written after
+        the rows as ``nextCursor``.
+        """
+
+        attrs = request.params['attrs'].split(',')
+
+        fields = []
+        for k in attrs:
+            name = k
+            if name_mapping is not None and k in name_mapping:
+                name = name_mapping[k]
+            fields.append({'name': name, 'type': self._ext_field_type(k)})
+
+        metaData = {'totalProperty': 'totalResults', 'root': 'rows', 'fields': fields}
+
+        if count == "window":
+            metaData['countStrategy'] = count
+            chunks = self._iter_ext_window(request, query, filter, metaData, page)
+        else:
+            with self.observer.span("count", format='ext'):
+                total, metaData['countStrategy'] = self._ext_total(request, filter, count, version)
+            chunks = self._iter_ext(query, total, metaData, page)
+
+        if stream:
+            return chunks
+
+        return ''.join(chunks)
+
+    def _iter_ext(self, query, total, metaData, page=None):
+
+        names = [f['name'] for f in metaData['fields']]
+
+        yield '{"totalResults": %s, "metaData": %s, "rows": [' % (json.dumps(total), json.dumps(metaData))
+
+        rows = query.execution_options(stream_results=True).yield_per(BATCH_SIZE)
+        if page is not None:
+            rows = page.rows(rows)
+
+        separator = ''
+        for row in rows:
+            yield separator + json.dumps(dict(zip(names, row)))
+            separator = ', '
+
+        if page is not None:
+            yield '], "nextCursor": %s}' % json.dumps(page.next_cursor())
+        else:
+            yield ']}'
+
+    def _iter_ext_window(self, request, query, filter, metaData, page=None):
+
+        names = [f['name'] for f in metaData['fields']]
+
+        yield '{"metaData": %s, "rows": [' % json.dumps(metaData)
+
+        rows = query.execution_options(stream_results=True).yield_per(BATCH_SIZE)
+        if page is not None:
+            rows = page.rows(rows)
+
+        total = None
+        separator = ''
+        for row in rows:
+            total = row.total_count
+            yield separator + json.dumps(dict(zip(names, row)))
+            separator = ', '
+
+        if total is None:
+            # A page past the last row has no row to carry the total
+            total = 0 if not request.params.get('offset') else self.count(request, filter)
+
+        if page is not None:
+            yield '], "totalResults": %s, "nextCursor": %s}' % (json.dumps(total), json.dumps(page.next_cursor()))
+        else:
+            yield '], "totalResults": %s}' % json.dumps(total)
+
+    def _ext_total(self, request, filter, strategy, version=None):
+        """
+        Return the total number of results of the ext format and the
+        strategy which was actually used to get it.
+        """
+
+        if strategy == "estimate" and self._dialect_name() == 'postgresql':
+            estimate = self._estimate_count(request, filter)
+            if estimate is not None and estimate >= COUNT_ESTIMATE_MIN:
+                return estimate, "estimate"
+            return self.count(request, filter), "exact"
+
+        if strategy == "cached" and self.count_cache is not None:
+            # Paging and sorting don't change the count
+            params = dict((k, v) for k, v in request.params.items() if k not in ('limit', 'offset', 'maxfeatures', 'order_by', 'dir', 'cursor'))
+            key = (self.mapped_class.__name__, normalize_params(params), self._filter_key(filter))
+
+            entry = self.count_cache.get(key, version)
+            if entry is not None and time.time() - entry[1] < self.count_ttl:
+                return entry[0], "cached"
+
+            total = self.count(request, filter)
+            self.count_cache.set(key, (total, time.time()), version)
+            return total, "exact"
+
+        return self.count(request, filter), "exact"
+
+    def _estimate_count(self, request, filter):
+        """
+        Return the number of rows the PostgreSQL planner estimates for the
+        filter, from the table statistics if there's no filter at all. None
+        is returned if there are no statistics.
+        """
+
+        if filter is None:
+            filter = create_filter(request, self.mapped_class, 'wkb_geometry')
+
+        if filter is None:
+            table = class_mapper(self.mapped_class).local_table
+            name = table.name if table.schema is None else "%s.%s" % (table.schema, table.name)
+            reltuples = self.Session.execute(text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"),
+                                             {'name': name}).scalar()
+            # Tables which were never analyzed have no (or -1) reltuples
+            if reltuples is None or reltuples < 0:
+                return None
+            return int(reltuples)
+
+        statement = self.Session.query(self._primary_key()).filter(filter).statement
+        compiled = statement.compile(dialect=self.Session.get_bind(class_mapper(self.mapped_class)).dialect)
+        plan = self.Session.connection().execute("EXPLAIN (FORMAT JSON) " + unicode(compiled), compiled.params).scalar()
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def _ext_field_type(self, attr):
+        """
+        Return the Ext field type of the attribute ``attr`` of the mapped
+        class based on its column type.
+        """
+
+        try:
+            column_type = getattr(self.mapped_class, attr).property.columns[0].type
+        except AttributeError:
+            return 'string'
+
+        if isinstance(column_type, Boolean):
+            return 'boolean'
+        elif isinstance(column_type, Integer):
+            return 'int'
+        elif isinstance(column_type, (Float, Numeric)):
+            return 'float'
+
+        return 'string'
+
+
+    """
+    def _plot_histogram(self, request, query, **kwargs):
+
+        # Get the requested attribute
+        attr = request.params.get('attrs').split(",")[0]
+
+        defaultSide = 480
+
+        try:
+            height = int(request.params.get("height", defaultSide))
+        except ValueError:
+            height = defaultSide
+        try:
+            width = int(request.params.get("width", defaultSide))
+        except ValueError:
+            width = defaultSide
+
+        rbreaks = 10
+        if 'breaks' in request.params:
+            rbreaks = int(request.params['breaks'])
+
+        rinterface.initr()
+
+        r = robjects.r
+        r.library('grDevices')
+
+        mappedAttribute = getattr(self.mapped_class, attr)
+
+        # Create a temporary file
+        if 'filename' in kwargs:
+            file = open(kwargs['filename'], 'wb')
+        else:
+            # Create a temporary file
+            file = NamedTemporaryFile()
+        r.png(file.name, width=width, height=height)
+        r.par(bg="#F0F0F0", mar=robjects.FloatVector([2.6, 4.1, 3.1, 1.1]))
+
+        bar_color = "#BEBEBE"
+
+        # If categories is not none, then the current attribute has categories and
+        # we want to draw a barplot instead of a histogram
+        if "categories" in kwargs and kwargs['categories'] is not None:
+            categories = kwargs['categories']
+
+            names = []
+            v = []
+            #for i in self.Session.query(func.count(mappedAttribute)).filter(mappedAttribute.in_(keys)).group_by(mappedAttribute):
+            for a, count in query.from_self(mappedAttribute, func.count(mappedAttribute)).filter(mappedAttribute.in_(categories.keys())).group_by(mappedAttribute):
+                v.append(int(count))
+                names.append(categories[unicode(a)].encode('UTF-8'))
+            x = robjects.IntVector(v)
+
+            x.names = robjects.StrVector(names)
+            r.barplot(x, col=bar_color, xlab=str(), ylab=str(), main=str(), ** {"names.arg": robjects.StrVector(names)})
+            #r.par(bg="#F0F0F0", mar=robjects.FloatVector([1.5, 1.5, 1.5, 1.5]))
+            #r.pie(x, labels=robjects.StrVector(names), clockwise=True)
+
+        # Handle quantitative data
+        else:
+
+            v = []
+            for i in query.all():
+                v.append(getattr(i, attr))
+
+            x = robjects.FloatVector(v)
+
+            r.hist(x, col=bar_color, breaks=rbreaks, ylab=str(), xlab=str(), main=str())
+
+        # Finish drawing
+        r('dev.off()')
+
+        f = open(file.name, 'r')
+
+        return f"""
+
+
+    def _plot_histogram(self, request, query, ** kwargs):
+        """
+        Alternative implementation with matplotlib instead of R
+        """
+
+        # Get the first requested attribute
+        attr = request.params.get('attrs').split(",")[0]
+
+        # Set a default value for the image size in pixel
+        defaultSide = 480.0
+        # Set the dpi
+        dpi = 96.0
+
+        try:
+            height = float(request.params.get("height", defaultSide))
+        except ValueError:
+            height = defaultSide
+        try:
+            width = float(request.params.get("width", defaultSide))
+        except ValueError:
+            width = defaultSide
+
+        mappedAttribute = getattr(self.mapped_class, attr)
+
+        fig = plt.figure(figsize=(width / dpi, height / dpi))
+        ax = fig.add_subplot(111)
+
+        # Set fontProperties
+        fontProperties = matplotlib.font_manager.FontProperties(family="sans-serif", size='x-small')
+
+        # Set smaller fonts
+        [i.set_fontproperties(fontProperties) for i in ax.get_yticklabels()]
+        [j.set_fontproperties(fontProperties) for j in ax.get_xticklabels()]
+
+        # If categories is not none, then the current attribute has categories and
+        # we want to draw a barplot instead of a histogram
+        if kwargs["categories"] is not None:
+
+            categories = kwargs["categories"]
+
+            v = []
+            names = []
+            with self.observer.span("query", format='hist'):
+                for a, count in query.from_self(mappedAttribute, func.count(mappedAttribute)).filter(mappedAttribute.in_(categories.keys())).group_by(mappedAttribute):
+                    v.append(int(count))
+                    names.append(categories[unicode(a)].encode('UTF-8'))
+
+            N = len(v)
+
+            ind = range(N)
+
+            # the histogram of the data
+            ax.bar(np.array(ind) + 0.1, v, width=0.8, color=kwargs.get("color"))
+
+            # hist uses np.histogram under the hood to create 'n' and 'bins'.
+            # np.histogram returns the bin edges, so there will be 50 probability
+            # density values in n, 51 bin edges in bins and 50 patches.  To get
+            # everything lined up, we'll compute the bin centers
+            ax.set_xticks(np.arange(len(v)) + 0.5)
+            ax.set_xticklabels(names)
+
+        else:
+
+            # Let the database bin the values, only the counts are fetched
+            with self.observer.span("query", format='hist'):
+                edges, n = self._histogram_counts(query, mappedAttribute, breaks=request.params.get("breaks"))
+
+            # the histogram of the precomputed counts
+            ax.bar(edges[:-1], n, width=np.diff(edges), align='edge', color=kwargs.get("color"), alpha=0.75)
+
+            """
+            n, bins = np.histogram(v, distinct_value)
+
+            # get the corners of the rectangles for the histogram
+            left = np.array(bins[:-1])
+            right = np.array(bins[1:])
+            bottom = np.zeros(len(left))
+            top = bottom + n
+            nrects = len(left)
+
+            nverts = nrects*(1+3+1)
+            verts = np.zeros((nverts, 2))
+            codes = np.ones(nverts, int) * matplotlib.path.Path.LINETO
+            codes[0::5] = matplotlib.path.Path.MOVETO
+            codes[4::5] = matplotlib.path.Path.CLOSEPOLY
+            verts[0::5,0] = left
+            verts[0::5,1] = bottom
+            verts[1::5,0] = left
+            verts[1::5,1] = top
+            verts[2::5,0] = right
+            verts[2::5,1] = top
+            verts[3::5,0] = right
+            verts[3::5,1] = bottom
+
+            barpath = matplotlib.path.Path(verts, codes)
+            patch = matplotlib.patches.PathPatch(barpath, facecolor=kwargs.get("color"), alpha=0.75)
+            ax.add_patch(patch)
+
+            ax.set_xlim(0, right[-1])
+            ax.set_ylim(bottom.min(), top.max())
+            """
+
+            # hist uses np.histogram under the hood to create 'n' and 'bins'.
+            # np.histogram returns the bin edges, so there will be 50 probability
+            # density values in n, 51 bin edges in bins and 50 patches.  To get
+            # everything lined up, we'll compute the bin centers
+
+        if 'xlabel' in kwargs:
+            ax.set_xlabel(kwargs['xlabel'], fontproperties=fontProperties)
+        if 'ylabel' in kwargs:
+            ax.set_ylabel(kwargs['ylabel'], fontproperties=fontProperties)
+
+
+        ax.grid(True)
+
+        file = StringIO()
+        with self.observer.span("render", format='hist') as span:
+            fig.savefig(file, dpi=dpi, format="png")
+            span.add(bytes=file.tell())
+
+        # Release the figure, pyplot keeps a reference to it otherwise
+        plt.close(fig)
+
+        if kwargs.get("filename") is not None:
+            self._write_file(kwargs["filename"], file.getvalue())
+
+        file.seek(0)  # rewind the data
+
+        return file
+
+    def _histogram_key(self, request, filter, plot_kwargs):
+        """
+        Return the cache key of a histogram: the mapped class, the normalized
+        request parameters (attribute, filter, size and breaks), the filter
+        passed to ``read`` and the plot options.
+        """
+
+        categories = plot_kwargs.get('categories')
+        if categories is not None:
+            categories = normalize_params(categories, ignore=())
+
+        return (self.mapped_class.__name__,
+                normalize_params(request.params),
+                self._filter_key(filter),
+                categories,
+                plot_kwargs.get('color'),
+                plot_kwargs.get('xlabel'),
+                plot_kwargs.get('ylabel'))
+
+    def _data_version(self, ** kwargs):
+        """
+        Return the version token of the data: the ``version`` keyword argument
+        if given, otherwise the result of the ``version_token`` callable.
+        """
+
+        if kwargs.get("version") is not None:
+            return kwargs["version"]
+
+        if self.version_token is not None:
+            return self.version_token()
+
+        return None
+
+    def _write_file(self, filename, content):
+
+        f = open(filename, 'wb')
+        f.write(content)
+        f.close()
+
+    def _read_mvt(self, request, filter=None, ** kwargs):
+        """
+        Encode the features intersecting the tile ``z``/``x``/``y`` (keyword
+        arguments or request parameters) as Mapbox Vector Tile with the
+        requested ``attrs``.
+
+        The geometries are transformed to Web Mercator in the database,
+        clipped to the tile extent plus a buffer and quantized to the tile
+        grid. If the protocol has a tile cache, the encoded tiles are cached
+        per layer, tile, attributes and filter.
+        """
+
+        mapbox_vector_tile = import_optional("mapbox_vector_tile", 'mvt', "mapbox-vector-tile")
+        from papyrus_formats.geometry import decode_clipped
+        from papyrus_formats.geometry import tile_bounds
+
+        try:
+            z = int(kwargs.get('z', request.params.get('z')))
+            x = int(kwargs.get('x', request.params.get('x')))
+            y = int(kwargs.get('y', request.params.get('y')))
+        except (TypeError, ValueError):
+            abort(400)
+
+        attrs = []
+        if 'attrs' in request.params:
+            attrs = request.params['attrs'].split(',')
+
+        layer = kwargs.get('layer', self.mapped_class.__tablename__)
+
+        key = None
+        if self.tile_cache is not None:
+            version = self._data_version(** kwargs)
+            key = (layer, z, x, y, tuple(attrs), normalize_params(request.params), self._filter_key(filter))
+            tile = self.tile_cache.get(key, version)
+            if tile is not None:
+                return tile
+
+        bounds = tile_bounds(z, x, y)
+        buffered = tile_bounds(z, x, y, buffer=float(MVT_BUFFER) / MVT_EXTENT)
+
+        geometry = getattr(self.mapped_class, 'wkb_geometry')
+
+        # The buffered tile in the coordinate system of the geometry column
+        envelope = func.ST_Transform(func.ST_MakeEnvelope(* (buffered + (3857,))), self._geometry_srid())
+
+        mapped_attributes = []
+        mapped_attributes.append(functions.wkb(functions.transform(geometry, 3857)).label("geometry_column"))
+        for attr in attrs:
+            mapped_attributes.append(getattr(self.mapped_class, attr))
+
+        if filter is None:
+            filter = create_filter(request, self.mapped_class, 'wkb_geometry')
+
+        query = self.Session.query(* mapped_attributes).filter(func.ST_Intersects(geometry, envelope))
+        if filter is not None:
+            query = query.filter(filter)
+
+        features = []
+        query = query.execution_options(stream_results=True).yield_per(BATCH_SIZE)
+        for rows in iter_batches(query, BATCH_SIZE):
+            geometries = decode_clipped([getattr(i, 'geometry_column') for i in rows], buffered)
+            for i, g in zip(rows, geometries):
+                if g is None or g.is_empty:
+                    continue
+
+                # Vector tiles have no null values
+                properties = {}
+                for attr in attrs:
+                    value = getattr(i, attr)
+                    if value is not None:
+                        properties[attr] = value
+
+                features.append({'geometry': g, 'properties': properties})
+
+        layers = [{'name': layer, 'features': features}]
+
+        try:
+            tile = mapbox_vector_tile.encode(layers, default_options={'quantize_bounds': bounds, 'extents': MVT_EXTENT})
+        except TypeError:
+            # mapbox-vector-tile before 2.0
+            tile = mapbox_vector_tile.encode(layers, quantize_bounds=bounds, extents=MVT_EXTENT)
+
+        if key is not None:
+            self.tile_cache.set(key, tile, version)
+
+        return tile
+
+    def _read_columnar(self, request, query, format='parquet', ** kwargs):
+        """
+        Write the rows of ``query`` (see ``_export_query``) as GeoParquet
+        file or, with format 'arrow', as Arrow IPC stream, with the geometry
+        as WKB column. The record batches are built from the cursor batches
+        with column types derived from the mapped class and are written to
+        Parquet in row groups of ``PARQUET_ROW_GROUP_SIZE`` rows. The metadata
+        is embedded as file-level key/value metadata. The output is returned
+        in a spooled temporary file.
+        """
+
+        pa = import_optional("pyarrow", format)
+        import_optional("pyarrow.ipc", format)
+        pq = import_optional("pyarrow.parquet", format)
+        from papyrus_formats.geometry import reproject_wkb
+
+        requested_attrs = request.params.get("attrs").split(",")
+
+        epsg = kwargs.get("epsg", 4326)
+
+        fields = [pa.field(str(a), self._arrow_type(a)) for a in requested_attrs]
+        fields.append(pa.field("geometry", pa.binary()))
+
+        column = {'encoding': 'WKB', 'geometry_types': []}
+        # Without crs GeoParquet readers assume longitude/latitude
+        if epsg != 4326:
+            column['crs'] = epsg_projjson(epsg)
+
+        file_metadata = {'geo': json.dumps({'version': '1.0.0', 'primary_column': 'geometry', 'columns': {'geometry': column}})}
+
+        metadata = kwargs.get("metadata")
+        if metadata is not None:
+            file_metadata['papyrus_formats:metadata'] = json.dumps({'headers': metadata.get_headers(),
+                                                                    'rows': metadata.get_rows(),
+                                                                    'address': metadata.get_address()})
+
+        schema = pa.schema(fields, metadata=file_metadata)
+
+        s = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+        if format == 'arrow':
+            writer = pa.ipc.new_stream(s, schema)
+        else:
+            writer = pq.ParquetWriter(s, schema)
+
+        progress = kwargs.get("progress")
+
+        # Batches waiting for the next Parquet row group
+        pending = []
+
+        def write_row_group():
+            writer.write_table(pa.Table.from_batches(pending, schema=schema), row_group_size=PARQUET_ROW_GROUP_SIZE)
+            del pending[:]
+
+        count = 0
+        query = query.execution_options(stream_results=True).yield_per(BATCH_SIZE)
+        with self.observer.span("write", format=format) as span:
+            for rows in iter_batches(query, BATCH_SIZE):
+                columns = [pa.array(self._arrow_values([getattr(i, a) for i in rows], fields[n].type), type=fields[n].type) for n, a in enumerate(requested_attrs)]
+                columns.append(pa.array(reproject_wkb([getattr(i, 'geometry_column') for i in rows], kwargs.get("reproject")), type=pa.binary()))
+
+                batch = pa.RecordBatch.from_arrays(columns, schema=schema)
+                if format == 'arrow':
+                    writer.write_batch(batch)
+                else:
+                    pending.append(batch)
+                    if sum(b.num_rows for b in pending) >= PARQUET_ROW_GROUP_SIZE:
+                        write_row_group()
+
+                span.add(rows=len(rows))
+
+                count += len(rows)
+                if progress is not None:
+                    progress(count)
+
+            if len(pending) > 0:
+                write_row_group()
+
+        writer.close()
+
+        s.seek(0)
+
+        return s
+
+    def _arrow_type(self, attr):
+        """
+        Return the Arrow type of the attribute ``attr`` of the mapped class
+        based on its column type.
+        """
+
+        pa = import_optional("pyarrow", 'arrow')
+
+        try:
+            column_type = getattr(self.mapped_class, attr).property.columns[0].type
+        except AttributeError:
+            return pa.string()
+
+        if isinstance(column_type, Boolean):
+            return pa.bool_()
+        elif isinstance(column_type, Integer):
+            return pa.int64()
+        elif isinstance(column_type, (Float, Numeric)):
+            return pa.float64()
+        elif isinstance(column_type, DateTime):
+            return pa.timestamp('us')
+        elif isinstance(column_type, Date):
+            return pa.date32()
+
+        return pa.string()
+
+    def _read_fgb(self, request, query, ** kwargs):
+        """
+        Write the rows of ``query`` (see ``_export_query``) as FlatGeobuf
+        file with its packed Hilbert R-tree index, so that clients can read
+        bounding boxes with range requests. The geometry type of the layer is
+        left open, which allows single and multi geometries of all types.
+        The file is written by GDAL to a temporary directory and returned in
+        a spooled temporary file.
+        """
+
+        fiona = import_optional("fiona", 'fgb')
+        import_optional("fiona.crs", 'fgb')
+        from papyrus_formats.geometry import decode_geometries
+        from shapely.geometry import mapping
+
+        requested_attrs = request.params.get("attrs").split(",")
+
+        schema = {'geometry': 'Unknown', 'properties': [(str(a), self._fgb_field_type(a)) for a in requested_attrs]}
+
+        progress = kwargs.get("progress")
+
+        directory = mkdtemp()
+
+        try:
+            filename = os.path.join(directory, "data.fgb")
+
+            count = 0
+            query = query.execution_options(stream_results=True).yield_per(BATCH_SIZE)
+            with fiona.open(filename, 'w', driver="FlatGeobuf", schema=schema,
+                            crs=fiona.crs.from_epsg(kwargs.get("epsg", 4326)), SPATIAL_INDEX="YES") as c:
+
+                for rows in iter_batches(query, BATCH_SIZE):
+                    with self.observer.span("decode", format='fgb'):
+                        geometries = decode_geometries([getattr(i, 'geometry_column') for i in rows], kwargs.get("reproject"))
+
+                    with self.observer.span("write", format='fgb') as span:
+                        records = []
+                        for i, g in zip(rows, geometries):
+                            properties = [(str(a), self._fgb_value(getattr(i, a))) for a in requested_attrs]
+                            records.append({'geometry': None if g is None or g.is_empty else mapping(g),
+                                            'properties': OrderedDict(properties)})
+                        c.writerecords(records)
+                        span.add(rows=len(rows))
+
+                    count += len(rows)
+                    if progress is not None:
+                        progress(count)
+
+            # The spatial index is built when the file is closed
+            s = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            f = open(filename, 'rb')
+            try:
+                shutil.copyfileobj(f, s)
+            finally:
+                f.close()
+
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        s.seek(0)
+
+        return s
+
+    def _arrow_values(self, values, arrow_type):
+        """
+        Convert the values of a column to the Python types Arrow accepts for
+        ``arrow_type``: Numeric columns return Decimals, which can't be
+        converted to floating point arrays, and string columns may hold
+        values of other types.
+        """
+
+        pa = import_optional("pyarrow", 'arrow')
+
+        if pa.types.is_floating(arrow_type):
+            return [None if v is None else float(v) for v in values]
+        elif pa.types.is_string(arrow_type):
+            return [v if v is None or isinstance(v, basestring) else unicode(v) for v in values]
+
+        return values
+
+    def _fgb_field_type(self, attr):
+        """
+        Return the fiona field type of the attribute ``attr`` of the mapped
+        class based on its column type.
+        """
+
+        try:
+            column_type = getattr(self.mapped_class, attr).property.columns[0].type
+        except AttributeError:
+            return 'str'
+
+        if isinstance(column_type, Boolean):
+            return 'bool'
+        elif isinstance(column_type, Integer):
+            return 'int'
+        elif isinstance(column_type, (Float, Numeric)):
+            return 'float'
+        elif isinstance(column_type, DateTime):
+            return 'datetime'
+        elif isinstance(column_type, Date):
+            return 'date'
+
+        return 'str'
+
+    def _fgb_value(self, value):
+
+        if isinstance(value, Decimal):
+            return float(value)
+        elif isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+
+        return value
+
+    def _histogram_counts(self, query, mappedAttribute, breaks=None):
+        """
+        Bin the values of ``mappedAttribute`` in the database and return the
+        bin edges and the count of values per bin as NumPy arrays.
+
+        If ``breaks`` is not set, the number of bins is derived from the
+        number of distinct values.
+        """
 
-    def _write_metadata(self, workbook, metadata):
+        # Get the range and the number of (distinct) values in one query
+        vmin, vmax, count, distinct_value = query.from_self(
+                                                            func.min(mappedAttribute),
+                                                            func.max(mappedAttribute),
+                                                            func.count(mappedAttribute),
+                                                            func.count(distinct(mappedAttribute))).one()
 
-        sheet = workbook.add_sheet("metadata")
+        bins = self._histogram_bins(breaks, distinct_value)
+
+        # No values at all
+        if vmin is None:
+            return np.array([0.0, 1.0]), np.array([0])
+
+        vmin = float(vmin)
+        vmax = float(vmax)
+
+        # All values are equal, put them in a single bin around the value
+        if bins < 1 or vmax == vmin:
+            return np.array([vmin - 0.5, vmax + 0.5]), np.array([count])
+
+        bucket = self._bucket_expression(mappedAttribute, vmin, vmax, bins)
+
+        counts = np.zeros(bins, dtype=int)
+        for b, c in query.from_self(bucket, func.count(mappedAttribute)).filter(mappedAttribute != None).group_by(bucket):
+            # The maximum value falls in an extra bucket, add it to the last bin
+            counts[min(max(int(b), 0), bins - 1)] += int(c)
+
+        return np.linspace(vmin, vmax, bins + 1), counts
+
+    def _histogram_bins(self, breaks, distinct_value):
+        """
+        Return the number of bins, ``breaks`` if set, otherwise derived from
+        the number of distinct values.
+        """
+
+        try:
+            return int(breaks)
+        except (TypeError, ValueError):
+            bins = distinct_value
+            # Limit the breaks to 100
+            if bins > 100:
+                bins = 100
+            # In case of less distinct values, limit the number of breaks
+            elif bins > 20 and bins < 100:
+                bins = int(bins / 2)
+            return bins
+
+    def _bucket_expression(self, mappedAttribute, vmin, vmax, bins):
+        """
+        Return the SQL expression of the 0-based bin of the values of
+        ``mappedAttribute`` in ``bins`` equal bins between ``vmin`` and
+        ``vmax``. The maximum falls in the extra bin ``bins``.
+        """
+
+        step = (vmax - vmin) / bins
+
+        dialect = self._dialect_name()
+        if dialect == 'postgresql':
+            return func.width_bucket(mappedAttribute, vmin, vmax, bins) - 1
+        elif dialect == 'sqlite':
+            # SQLite truncates when casting, which is floor for positive values
+            return cast((mappedAttribute - vmin) / step, Integer)
+
+        return func.floor((mappedAttribute - vmin) / step)
+
+    def _read_hist_json(self, request, filter=None, categories=None, stats=False):
+        """
+        Return the histograms of all requested ``attrs`` as JSON for client
+        side charts, the bin edges and counts of numeric attributes and the
+        counts per category of the attributes in ``categories``, which maps
+        attribute names to their category mappings like the ``categories``
+        of the hist format.
+
+        The ranges of all numeric attributes are queried at once, and all
+        bins and categories are then counted in a single query, a UNION ALL
+        of one grouped count per attribute over its bin or category index.
+        With ``stats`` the count, min, max and
+        mean of the numeric attributes are added, and on PostgreSQL the
+        ``HIST_QUANTILES`` too.
+        """
+
+        attrs = request.params.get('attrs').split(",")
+        if categories is None:
+            categories = {}
+
+        def aggregate(columns):
+            query = self.Session.query(* columns)
+            if filter is not None:
+                query = query.filter(filter)
+            return query.one()
+
+        numeric = [a for a in attrs if a not in categories]
+        quantiles = stats and self._dialect_name() == 'postgresql'
+
+        # The range of every numeric attribute and its summary statistics
+        columns = []
+        for a in numeric:
+            mappedAttribute = getattr(self.mapped_class, a)
+            columns.extend([func.min(mappedAttribute), func.max(mappedAttribute),
+                            func.count(mappedAttribute), func.count(distinct(mappedAttribute))])
+            if stats:
+                columns.append(func.avg(mappedAttribute))
+            if quantiles:
+                columns.extend(func.percentile_cont(q).within_group(mappedAttribute) for q in HIST_QUANTILES)
+
+        values = []
+        if len(columns) > 0:
+            with self.observer.span("query", format='hist_json'):
+                values = list(aggregate(columns))
+
+        result = OrderedDict()
+        # The grouped count queries and the counts they fill in
+        counts = []
+        queries = []
+
+        def group_count(mappedAttribute, index, histogram_counts):
+            query = self.Session.query(literal(len(counts), Integer).label("attribute"),
+                                       index.label("bucket"), func.count().label("count"))
+            query = query.filter(mappedAttribute != None)
+            if filter is not None:
+                query = query.filter(filter)
+            counts.append(histogram_counts)
+            queries.append(query.group_by(index))
+
+        for a in numeric:
+            vmin, vmax, count, distinct_value = values[:4]
+            values = values[4:]
+
+            histogram = {'type': 'numeric', 'edges': [0.0, 1.0], 'counts': [0]}
+
+            if stats:
+                histogram['stats'] = {'count': count, 'min': self._hist_number(vmin),
+                                      'max': self._hist_number(vmax), 'mean': self._hist_number(values.pop(0))}
+            if quantiles:
+                histogram['stats']['quantiles'] = OrderedDict((str(q), self._hist_number(values.pop(0))) for q in HIST_QUANTILES)
+
+            bins = self._histogram_bins(request.params.get("breaks"), distinct_value)
 
+            if vmin is not None and (bins < 1 or vmax == vmin):
+                # All values are equal, put them in a single bin around the value
+                histogram['edges'] = [float(vmin) - 0.5, float(vmax) + 0.5]
+                histogram['counts'] = [count]
+            elif vmin is not None:
+                vmin = float(vmin)
+                vmax = float(vmax)
+                histogram['edges'] = list(np.linspace(vmin, vmax, bins + 1))
+                histogram['counts'] = [0] * bins
+
+                mappedAttribute = getattr(self.mapped_class, a)
+                group_count(mappedAttribute, self._bucket_expression(mappedAttribute, vmin, vmax, bins), histogram['counts'])
+
+            result[a] = histogram
+
+        for a in attrs:
+            if a not in categories:
+                continue
+
+            mappedAttribute = getattr(self.mapped_class, a)
+
+            histogram = {'type': 'categories', 'categories': []}
+            for value, label in categories[a].items():
+                histogram['categories'].append({'value': value, 'label': label, 'count': 0})
+
+            histogram['counts'] = [0] * len(histogram['categories'])
+
+            if len(histogram['categories']) > 0:
+                index = case([(mappedAttribute == c['value'], i) for i, c in enumerate(histogram['categories'])], else_=None)
+                group_count(mappedAttribute, index, histogram['counts'])
+
+            result[a] = histogram
+
+        # Count all bins and categories with one query
+        if len(queries) > 0:
+            with self.observer.span("count", format='hist_json'):
+                for attribute, bucket, n in queries[0].union_all(* queries[1:]):
+                    if bucket is None:
+                        continue
+                    # The maximum falls in an extra bucket, add it to the last bin
+                    bucket = min(int(bucket), len(counts[attribute]) - 1)
+                    counts[attribute][bucket] += n
+
+        for histogram in result.values():
+            if histogram['type'] == 'categories':
+                for c, n in zip(histogram['categories'], histogram.pop('counts')):
+                    c['count'] = n
+
+        # Keep the order of the attrs parameter
+        return json.dumps(OrderedDict((a, result[a]) for a in attrs))
+
+    def _hist_number(self, value):
+
+        return None if value is None else float(value)
+
+    def _read_xls(self, request, query, ** kwargs):
+
+        requested_attrs = request.params.get("attrs").split(",")
+
+        workbook = xlwt.Workbook(encoding='utf-8')
+        sheet = workbook.add_sheet("data")
+        
         row = 0
+        column = 0
+        for a in requested_attrs:
+            sheet.write(row, column, a, xlwt.easyxf('font: bold true; borders: bottom THIN;'))
+            column += 1
+
+        row += 1
+        
+        progress = kwargs.get("progress")
+
+        with self.observer.span("write", format='xls') as span:
+            for i in query: #.all():
+                column = 0
+                for a in requested_attrs:
+                    sheet.write(row, column, getattr(i, a))
+                    column += 1
+
+                row += 1
+
+                # Report the number of written rows
+                if progress is not None and row % BATCH_SIZE == 0:
+                    progress(row - 1)
+
+            span.add(rows=row - 1)
+        
+        if kwargs.get("metadata", None) is not None:
+
+            self._write_metadata(workbook, kwargs.get("metadata"))
+
+        # Create a file-like object
+        s = StringIO()
+        # Save the workbook to the memory object
+        with self.observer.span("save", format='xls') as span:
+            workbook.save(s)
+            span.add(bytes=s.tell())
+        return s
+
+    def _read_xlsx(self, request, query, ** kwargs):
+        """
+        Write the rows of ``query``, which must select the requested
+        attributes as columns, to an Excel 2007+ workbook. The rows are
+        fetched through a server-side cursor and XlsxWriter flushes every
+        row to disk in its constant memory mode, so there's no row limit
+        and the memory used stays flat. The workbook is returned in a
+        spooled temporary file.
+        """
+
+        xlsxwriter = import_optional("xlsxwriter", 'xlsx', "XlsxWriter")
+
+        requested_attrs = request.params.get("attrs").split(",")
+
+        s = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+        workbook = xlsxwriter.Workbook(s, {'constant_memory': True})
+        sheet = workbook.add_worksheet("data")
+
+        header_style = workbook.add_format({'bold': True, 'bottom': 1})
+
+        sheet.write_row(0, 0, requested_attrs, header_style)
+
+        progress = kwargs.get("progress")
+
+        row = 1
+        query = query.execution_options(stream_results=True).yield_per(BATCH_SIZE)
+        with self.observer.span("write", format='xlsx') as span:
+            for i in query:
+                sheet.write_row(row, 0, i)
+                row += 1
+
+                # Report the number of written rows
+                if progress is not None and row % BATCH_SIZE == 0:
+                    progress(row - 1)
+
+            span.add(rows=row - 1)
+
+        if kwargs.get("metadata", None) is not None:
+            self._write_metadata_sheet(workbook.add_worksheet("metadata"),
+                                       kwargs.get("metadata"),
+                                       header_style,
+                                       workbook.add_format({'bold': True}))
+
+        with self.observer.span("save", format='xlsx') as span:
+            workbook.close()
+            span.add(bytes=s.tell())
+
+        s.seek(0)
+
+        return s
+
+    def _read_csv(self, request, query, ** kwargs):
+        """
+        Return an iterator of CSV chunks, the header line and then one chunk
+        per batch of rows fetched from a server-side cursor. ``query`` must
+        select the requested attributes as columns.
+        """
+
+        requested_attrs = request.params.get("attrs").split(",")
+
+        s = StringIO()
+        csv.writer(s).writerow([self._csv_value(a) for a in requested_attrs])
+        yield s.getvalue()
+
+        progress = kwargs.get("progress")
+
+        count = 0
+        batch_size = kwargs.get("batch_size", BATCH_SIZE)
+        query = query.execution_options(stream_results=True).yield_per(batch_size)
+        for rows in iter_batches(query, batch_size):
+            s = StringIO()
+            writer = csv.writer(s)
+            for i in rows:
+                writer.writerow([self._csv_value(v) for v in i])
+            yield s.getvalue()
+
+            # Report the number of written rows
+            count += len(rows)
+            if progress is not None:
+                progress(count)
+
+    def _csv_value(self, value):
+
+        if isinstance(value, unicode):
+            return value.encode("UTF-8")
+
+        return value
+
+    def _read_shp(self, request, query, ** kwargs):
+
+        requested_attrs = request.params.get("attrs").split(",")
+
+        # Get the first feature to guess the datatype
+        with self.observer.span("query", format='shp'):
+            first_record = query.first()
+
+        # Create geometry from AsBinary query
+        from shapely.wkb import loads
+        first_geom = loads(str(getattr(first_record, 'geometry_column')))
+
+        log.debug("Geometry type is %s" % first_geom.geom_type)
+
+        # Create the required files and fill them
+        shp = StringIO()
+        shx = StringIO()
+        dbf = StringIO()
+        cpg = StringIO()
+        prj = StringIO()
+
+        w = self._shp_writer(first_geom, shp=shp, shx=shx, dbf=dbf)
+
+        self._add_shp_fields(w, first_record, requested_attrs)
+
+        # Now query all features and decode their geometries batch by batch
+        with self.observer.span("query", format='shp') as span:
+            records = query.all()
+            span.add(rows=len(records))
+
+        for rows in iter_batches(records, BATCH_SIZE):
+            self._write_shp_rows(w, rows, requested_attrs, reproject=kwargs.get("reproject"))
+
+        # Write the headers, the file objects stay open
+        self._close_shp(w, shp=shp, shx=shx, dbf=dbf)
+        cpg.write("UTF-8")
+        prj.write(epsg_wkt(kwargs.get("epsg", 4326)))
+
+        # Create a memory file-like deflated zip file
+        with self.observer.span("compress", format='shp') as span:
+            s = StringIO()
+            f = ZipFile(s, 'w', ZIP_DEFLATED)
+            f.writestr("data.shp", shp.getvalue())
+            f.writestr("data.dbf", dbf.getvalue())
+            f.writestr("data.shx", shx.getvalue())
+            f.writestr("data.cpg", cpg.getvalue())
+            f.writestr("data.prj", prj.getvalue())
+
+
+            if kwargs.get("metadata") is not None:
+                wb = xlwt.Workbook(encoding='utf-8')
+
+                self._write_metadata(wb, kwargs.get("metadata"))
+                # Write the workbook to a file-like object
+                xls = StringIO()
+                # Save the workbook to the memory object
+                wb.save(xls)
+
+                f.writestr("metadata.xls", xls.getvalue())
+
+            # Close the zip file
+            f.close()
+
+            span.add(bytes=s.tell())
+
+        # And return the content
+        return s
+
+    def _read_shp_spooled(self, request, query, ** kwargs):
+        """
+        Same output as ``_read_shp``, but the shapefile is written to
+        temporary files while the rows come off the cursor and the ZIP
+        archive is built in a spooled temporary file, so the memory used
+        doesn't grow with the number of features.
+        """
+
+        directory = mkdtemp()
+
+        try:
+            members = self._write_shp_files(request, query, directory, ** kwargs)
+
+            return self._zip_members(directory, members, kwargs.get("metadata"))
+
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _zip_members(self, directory, members, metadata=None, format='shp'):
+        """
+        Return the ZIP archive of the files ``members`` in ``directory`` and
+        the ``metadata`` as metadata.xls, in a rewound spooled temporary
+        file.
+        """
+
+        if metadata is not None:
+            wb = xlwt.Workbook(encoding='utf-8')
+            self._write_metadata(wb, metadata)
+            wb.save(os.path.join(directory, "metadata.xls"))
+            members = members + ["metadata.xls"]
+
+        with self.observer.span("compress", format=format) as span:
+            s = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            f = ZipFile(s, 'w', ZIP_DEFLATED, allowZip64=True)
+            for name in members:
+                f.write(os.path.join(directory, name), name)
+            f.close()
+            span.add(bytes=s.tell())
+
+        # Rewind the archive before handing it over
+        s.seek(0)
+
+        return s
+
+    def _write_shp_files(self, request, query, directory, basename="data", ** kwargs):
+        """
+        Write the shapefile of ``query`` to ``directory`` and return the
+        names of the written files. The shapes and records are written to
+        disk as they are fetched.
+
+        With ``max_size``, the next batch of features goes to a new shapefile
+        <basename>_2, <basename>_3, ... if the .shp or .dbf file would grow
+        beyond ``max_size`` bytes with it, judging by the biggest batch so far.
+        """
+
+        requested_attrs = request.params.get("attrs").split(",")
+
+        # Get the first feature to guess the datatype
+        with self.observer.span("query", format='shp'):
+            first_record = query.first()
+
+        # Create geometry from AsBinary query
+        from shapely.wkb import loads
+        first_geom = loads(str(getattr(first_record, 'geometry_column')))
+
+        log.debug("Geometry type is %s" % first_geom.geom_type)
+
+        names = [basename]
+
+        w = self._shp_writer(first_geom, os.path.join(directory, basename))
+
+        self._add_shp_fields(w, first_record, requested_attrs)
+
+        progress = kwargs.get("progress")
+        max_size = kwargs.get("max_size")
+        if max_size is not None and not hasattr(w, "close"):
+            raise ImportError("Splitting shapefiles by size requires pyshp 2")
+
+        count = 0
+        # Biggest growth of the .shp and the .dbf file by one batch
+        growth = (0, 0)
+        batch_size = kwargs.get("batch_size", BATCH_SIZE)
+        query = query.execution_options(stream_results=True).yield_per(batch_size)
+        for rows in iter_batches(query, batch_size):
+            if max_size is not None:
+                sizes = (w.shp.tell(), w.dbf.tell())
+
+            if max_size is not None and max(sizes[0] + growth[0], sizes[1] + growth[1]) > max_size:
+                self._close_shp(w, os.path.join(directory, names[-1]))
+
+                names.append("%s_%d" % (basename, len(names) + 1))
+                log.debug("Continuing with shapefile %s" % names[-1])
+
+                w = self._shp_writer(first_geom, os.path.join(directory, names[-1]))
+                self._add_shp_fields(w, first_record, requested_attrs)
+                sizes = (w.shp.tell(), w.dbf.tell())
+
+            self._write_shp_rows(w, rows, requested_attrs, reproject=kwargs.get("reproject"))
+
+            if max_size is not None:
+                growth = (max(growth[0], w.shp.tell() - sizes[0]), max(growth[1], w.dbf.tell() - sizes[1]))
+
+            # Report the number of written rows
+            count += len(rows)
+            if progress is not None:
+                progress(count)
+
+        self._close_shp(w, os.path.join(directory, names[-1]))
+
+        files = []
+        for name in names:
+            target = os.path.join(directory, name)
+
+            cpg = open(target + ".cpg", 'w')
+            cpg.write("UTF-8")
+            cpg.close()
+
+            prj = open(target + ".prj", 'w')
+            prj.write(epsg_wkt(kwargs.get("epsg", 4326)))
+            prj.close()
+
+            files.extend([name + "." + ext for ext in ("shp", "dbf", "shx", "cpg", "prj")])
+
+        return files
+
+    def _shp_writer(self, geom, target=None, ** files):
+        """
+        Return a pyshp writer for geometries like ``geom``, writing to the
+        files at the path ``target`` or to the file objects ``shp``, ``shx``
+        and ``dbf``. The files are complete after ``_close_shp``.
+        """
+
+        if hasattr(shapefile.Writer, "close"):
+            w = shapefile.Writer(target, shapeType=self._shp_shape_type(geom), ** files)
+        else:
+            # The writers of pyshp 1 keep all shapes in memory until saved
+            w = shapefile.Writer(self._shp_shape_type(geom))
+
+        w.autoBalance = 1
+
+        return w
+
+    def _close_shp(self, w, target=None, ** files):
+        """
+        Finish the files of the writer ``w`` created by ``_shp_writer`` with
+        the same ``target`` or file objects.
+        """
+
+        if hasattr(w, "close"):
+            w.close()
+        elif target is not None:
+            w.save(target)
+        else:
+            w.saveShp(files['shp'])
+            w.saveShx(files['shx'])
+            w.saveDbf(files['dbf'])
+
+    def _shp_shape_type(self, geom):
+        """
+        Return the shapefile shape type to use for geometries like ``geom``.
+        Points are only written as POINT shapes if the geometry column can't
+        hold anything else, otherwise as MULTIPOINT shapes so that later
+        multipoints keep all their points.
+        """
+
+        shape_type = shp_shape_types.get(geom.geom_type, shapefile.POLYGON)
+
+        if shape_type == shapefile.POINT and self._geometry_type() != 'POINT':
+            return shapefile.MULTIPOINT
+
+        return shape_type
+
+    def _add_shp_fields(self, w, first_record, requested_attrs):
+
+        # Loop all requested attributes
+        for attr in requested_attrs:
+
+            first_value = getattr(first_record, attr)
+
+            # Guess the datatype
+            if isinstance(first_value, int):
+                w.field(str(attr), 'N', 40)
+            elif isinstance(first_value, float):
+                w.field(str(attr), 'N', 40, 10)
+            else:
+                w.field(str(attr), 'C', 40)
+
+    def _write_shp_rows(self, w, rows, requested_attrs, reproject=None):
+        """
+        Write the shapes and records of a batch of rows. The geometries of
+        the whole batch are decoded, and reprojected with ``reproject`` if
+        given, at once.
+        """
+
+        from papyrus_formats.geometry import iter_wkb_parts
+
+        with self.observer.span("decode", format='shp') as span:
+            geometries = list(iter_wkb_parts([getattr(i, 'geometry_column') for i in rows], reproject))
+            if span.enabled:
+                span.add(rows=len(rows), vertices=sum(len(part) for parts in geometries for part in parts))
+
+        with self.observer.span("write", format='shp'):
+            for i, parts in zip(rows, geometries):
+
+                self._write_shp_parts(w, parts)
+
+                w.record(* self._shp_values(i, requested_attrs))
+
+    def _write_shp_parts(self, w, parts):
+        """
+        Write a shape given as a list of parts (see ``iter_wkb_parts``)
+        according to the shape type of the writer. Multi geometries are
+        written as multipart shapes.
+        """
+
+        # Empty or missing geometries
+        if len(parts) == 0:
+            w.null()
+
+        # Handle point geometries
+        elif w.shapeType == shapefile.POINT:
+            w.point(parts[0][0][0], parts[0][0][1])
+
+        # Handle multipoint geometries
+        elif w.shapeType == shapefile.MULTIPOINT:
+            points = [p for part in parts for p in part]
+            if hasattr(w, "multipoint"):
+                w.multipoint(points)
+            else:
+                w.poly([points], shapeType=shapefile.MULTIPOINT)
+
+        # Handle (multi) linestring geometries
+        elif w.shapeType == shapefile.POLYLINE:
+            w.line(parts)
+
+        # Handle (multi) polygon geometries
+        else:
+            w.poly(parts)
+
+    def _shp_values(self, record, requested_attrs):
+
+        values = []
+        for v in requested_attrs:
+            # pyshp writes None as a missing value, "None" isn't a number
+            if getattr(record, v) is None:
+                values.append(None)
+                continue
+            try:
+                values.append(str(getattr(record, v)))
+            except UnicodeEncodeError:
+                values.append(str(getattr(record, v).encode("UTF-8")))
+
+        return values
+
+    def _write_metadata(self, workbook, metadata):
+
+        sheet = workbook.add_sheet("metadata")
 
         # Create a style that draws a bottom line
         bottomMediumStlye = xlwt.easyxf('font: bold true; borders: bottom THIN;')
 
+        self._write_metadata_sheet(sheet, metadata, bottomMediumStlye, xlwt.easyxf('font: bold true;'))
+
+    def _write_metadata_sheet(self, sheet, metadata, header_style, bold_style):
+        """
+        Write the metadata to ``sheet``, an xlwt or XlsxWriter worksheet. The
+        rows are written in ascending order, as required by the constant
+        memory mode of XlsxWriter.
+        """
+
+        row = 0
+
         # Write the column headers
         column = 0
         for h in metadata.get_headers():
-            sheet.write(row, column, h, bottomMediumStlye)
+            sheet.write(row, column, h, header_style)
             column += 1
             
         row += 1
@@ -628,15 +2502,28 @@ class FormatsProtocol(Protocol):
             sheet.write(row, 0, "*************************************************************")
             row += 1
             sheet.write(row, 0, "*")
-            sheet.write(row, 1, "Points of Contact", xlwt.easyxf('font: bold true;'))
+            sheet.write(row, 1, "Points of Contact", bold_style)
             row += 1
             sheet.write(row, 0, "*************************************************************")
 
-        for a in metadata.get_address():
-            row += 1
-            column = 0
-            for c in a:
-                sheet.write(row, 0, "*")
-                sheet.write(row, 1, c)
+            for a in metadata.get_address():
                 row += 1
-            sheet.write(row, 0, "*************************************************************")
\ No newline at end of file
+                column = 0
+                for c in a:
+                    sheet.write(row, 0, "*")
+                    sheet.write(row, 1, c)
+                    row += 1
+                sheet.write(row, 0, "*************************************************************")
+
+register_format('geojson', FormatsProtocol._format_geojson)
+register_format('ext', FormatsProtocol._format_ext)
+register_format('hist', FormatsProtocol._format_hist)
+register_format('hist_json', FormatsProtocol._format_hist_json)
+register_format('mvt', FormatsProtocol._format_mvt)
+register_format('xls', FormatsProtocol._format_xls, cached=True)
+register_format('xlsx', FormatsProtocol._format_xlsx, cached=True)
+register_format('csv', FormatsProtocol._format_csv, cached=True)
+register_format('parquet', FormatsProtocol._format_columnar, cached=True)
+register_format('arrow', FormatsProtocol._format_columnar, cached=True)
+register_format('fgb', FormatsProtocol._format_fgb, cached=True)
+register_format('shp', FormatsProtocol._format_shp, cached=True)
@@ -0,0 +1,151 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+The registry of the output formats of ``FormatsProtocol.read``.
+
+A format handler is called as ``handler(protocol, request, filter, id,
+format=format, ** kwargs)`` with the arguments of ``read`` and returns the
+result. Handlers can be registered from outside this package, as callables or
+as dotted paths which are only imported when the format is first read:
+
+    register_format('kml', 'myapp.formats:read_kml', cached=True)
+
+The heavy dependencies of the formats are loaded on first use as well, with
+``LazyModule``, ``import_optional`` or imports inside the handlers, so a
+deployment serving only GeoJSON never imports matplotlib, NumPy, pyproj or
+the spreadsheet and shapefile writers, and Shapely only if geometries are
+simplified.
+"""
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 4:52:37 PM$"
+
+from importlib import import_module
+import threading
+
+_formats = {}
+_lock = threading.Lock()
+
+def register_format(name, handler, cached=False):
+    """
+    Register ``handler`` as the handler of the format ``name``, replacing a
+    registered one. ``handler`` is a callable or the dotted path of one, like
+    'package.module:function'. The exported files of ``cached`` formats are
+    served from the artifact cache of the protocol.
+    """
+
+    with _lock:
+        _formats[name] = {'handler': handler, 'cached': cached}
+
+def unregister_format(name):
+
+    with _lock:
+        _formats.pop(name, None)
+
+def get_format(name):
+    """
+    Return the handler of the format ``name``, or None if there's no such
+    format. Dotted paths are imported on the first call.
+    """
+
+    with _lock:
+        entry = _formats.get(name)
+        if entry is None:
+            return None
+
+        if not callable(entry['handler']):
+            entry['handler'] = resolve(entry['handler'])
+
+        return entry['handler']
+
+def is_cached(name):
+
+    with _lock:
+        entry = _formats.get(name)
+        return entry is not None and entry['cached']
+
+def formats():
+    """
+    Return the names of the registered formats.
+    """
+
+    with _lock:
+        return sorted(_formats)
+
+def resolve(path):
+    """
+    Import the object at the dotted path 'package.module:attribute', where
+    the attribute can be nested like 'Class.method'.
+    """
+
+    module, _, attrs = path.partition(":")
+
+    obj = import_module(module)
+    for attr in attrs.split(".") if attrs else []:
+        obj = getattr(obj, attr)
+
+    return obj
+
+def import_optional(name, format, package=None):
+    """
+    Import the optional dependency ``name`` of ``format``, or raise an
+    ImportError saying which format needs it (the distribution ``package``,
+    by default the module name).
+    """
+
+    try:
+        return import_module(name)
+    except ImportError:
+        raise ImportError("The %s format requires %s" % (format, package or name.split(".")[0]))
+
+class LazyModule(object):
+    """
+    A stand-in for the module ``name`` which is imported on the first
+    attribute access. ``setup`` is called right before the import, e.g. to
+    select the matplotlib backend.
+    """
+
+    def __init__(self, name, setup=None):
+
+        self._name = name
+        self._setup = setup
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+
+        with self._lock:
+            if self._module is None:
+                if self._setup is not None:
+                    self._setup()
+                self._module = import_module(self._name)
+
+        return self._module
+
+    def __getattr__(self, attr):
+
+        # Only called for attributes which aren't set in __init__
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+
+        return "<lazy module %r>" % self._name
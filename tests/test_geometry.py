@@ -0,0 +1,146 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests of the decoding of WKB geometries into shapefile parts, and of the
+shapes written from them.
+"""
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 8:47:03 PM$"
+
+from collections import namedtuple
+from io import BytesIO
+from papyrus_formats.geometry import geometry_parts
+from papyrus_formats.geometry import iter_wkb_parts
+from papyrus_formats.protocol import FormatsProtocol
+from shapely import wkt
+import shapefile
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import LargeBinary
+from sqlalchemy.ext.declarative import declarative_base
+import unittest
+
+Base = declarative_base()
+
+class Feature(Base):
+    __tablename__ = "feature"
+
+    id = Column(Integer, primary_key=True)
+    wkb_geometry = Column(LargeBinary)
+
+Row = namedtuple("Row", ["id", "geometry_column"])
+
+def wkb(text):
+
+    return wkt.loads(text).wkb
+
+class WKBPartsTest(unittest.TestCase):
+
+    def parts(self, texts, reproject=None):
+
+        return list(iter_wkb_parts([None if t is None else wkb(t) for t in texts], reproject))
+
+    def test_single_geometries(self):
+
+        self.assertEqual(self.parts(["POINT (1 2)"]), [[[[1.0, 2.0]]]])
+        self.assertEqual(self.parts(["LINESTRING (0 0, 1 1, 2 0)"]), [[[[0.0, 0.0], [1.0, 1.0], [2.0, 0.0]]]])
+        self.assertEqual(self.parts(["POLYGON ((0 0, 4 0, 4 4, 0 0), (1 1, 2 1, 2 2, 1 1))"]),
+                         [[[[0.0, 0.0], [4.0, 0.0], [4.0, 4.0], [0.0, 0.0]],
+                           [[1.0, 1.0], [2.0, 1.0], [2.0, 2.0], [1.0, 1.0]]]])
+
+    def test_multi_geometries_keep_all_parts(self):
+
+        self.assertEqual(self.parts(["MULTIPOINT ((1 1), (2 2), (3 3))"]), [[[[1.0, 1.0], [2.0, 2.0], [3.0, 3.0]]]])
+        self.assertEqual(self.parts(["MULTILINESTRING ((0 0, 1 1), (2 2, 3 3))"]),
+                         [[[[0.0, 0.0], [1.0, 1.0]], [[2.0, 2.0], [3.0, 3.0]]]])
+        self.assertEqual(self.parts(["MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)), ((5 5, 6 5, 6 6, 5 5)))"]),
+                         [[[[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 0.0]],
+                           [[5.0, 5.0], [6.0, 5.0], [6.0, 6.0], [5.0, 5.0]]]])
+
+    def test_single_and_multi_geometries_mixed(self):
+
+        parts = self.parts(["POINT (0 0)", "MULTIPOINT ((1 1), (2 2))", "POINT (3 3)"])
+
+        self.assertEqual(parts, [[[[0.0, 0.0]]], [[[1.0, 1.0], [2.0, 2.0]]], [[[3.0, 3.0]]]])
+
+    def test_geometry_families_mixed(self):
+
+        texts = ["POINT (0 0)", "LINESTRING (0 0, 1 1)", "MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)))"]
+
+        self.assertEqual(self.parts(texts), [geometry_parts(wkt.loads(t)) for t in texts])
+
+    def test_geometry_collection(self):
+
+        texts = ["POINT (0 0)", "GEOMETRYCOLLECTION (POINT (1 1), LINESTRING (0 0, 2 2))"]
+
+        self.assertEqual(self.parts(texts), [[[[0.0, 0.0]]], [[[1.0, 1.0]], [[0.0, 0.0], [2.0, 2.0]]]])
+
+    def test_missing_and_empty_geometries(self):
+
+        parts = self.parts([None, "POINT (1 1)", "POLYGON EMPTY", None])
+
+        self.assertEqual(parts, [[], [[[1.0, 1.0]]], [], []])
+
+    def test_z_values_are_dropped(self):
+
+        self.assertEqual(self.parts(["LINESTRING Z (0 0 5, 1 1 6)"]), [[[[0.0, 0.0], [1.0, 1.0]]]])
+
+    def test_reproject(self):
+
+        def reproject(coords):
+            return coords * 2
+
+        self.assertEqual(self.parts(["MULTIPOINT ((1 1), (2 3))"], reproject), [[[[2.0, 2.0], [4.0, 6.0]]]])
+
+class ShapefileTest(unittest.TestCase):
+
+    def write(self, texts):
+        """
+        Write the geometries like an export does, the first one determines
+        the shape type, and return the points of the written shapes.
+        """
+
+        protocol = FormatsProtocol(None, Feature, 'wkb_geometry')
+        rows = [Row(i, wkb(t)) for i, t in enumerate(texts)]
+
+        files = {'shp': BytesIO(), 'shx': BytesIO(), 'dbf': BytesIO()}
+        w = protocol._shp_writer(wkt.loads(texts[0]), ** files)
+        protocol._add_shp_fields(w, rows[0], ["id"])
+        protocol._write_shp_rows(w, rows, ["id"])
+        protocol._close_shp(w, ** files)
+
+        reader = shapefile.Reader(** dict((k, BytesIO(f.getvalue())) for k, f in files.items()))
+
+        return [[list(p) for p in s.points] for s in reader.shapes()]
+
+    def test_multipoints_after_a_point(self):
+
+        points = self.write(["POINT (0 0)", "MULTIPOINT ((1 1), (2 2))"])
+
+        self.assertEqual(points, [[[0.0, 0.0]], [[1.0, 1.0], [2.0, 2.0]]])
+
+    def test_multipolygons_keep_all_rings(self):
+
+        points = self.write(["POLYGON ((0 0, 0 1, 1 1, 0 0))", "MULTIPOLYGON (((0 0, 0 1, 1 1, 0 0)), ((5 5, 5 6, 6 6, 5 5)))"])
+
+        self.assertEqual(len(points[1]), 8)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests of the keyset pagination cursors, on their own and through the
+queries of ``FormatsProtocol`` against an in-memory SQLite database.
+"""
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 8:24:51 PM$"
+
+import datetime
+from decimal import Decimal
+from papyrus_formats.jobs import JobRequest
+from papyrus_formats.pagination import KeysetPage
+from papyrus_formats.pagination import decode_cursor
+from papyrus_formats.pagination import encode_cursor
+from papyrus_formats.protocol import FormatsProtocol
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+import unittest
+
+Base = declarative_base()
+
+class Village(Base):
+    __tablename__ = "village"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(40), nullable=False)
+
+# Duplicate names, so that the primary key has to break the ties
+NAMES = [u"Ban Na", u"Ban Phone", u"Ban Na", u"Xieng Khouang", u"Ban Phone",
+         u"Ban Na", u"Muang Khoun", u"Ban Phone", u"Xieng Khouang", u"Ban Na"]
+
+class CursorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+
+        values = [42, u"Ban Na", 3.5, None]
+
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+
+    def test_dates_and_decimals(self):
+
+        # simplejson writes Decimals as JSON numbers
+        cursor = encode_cursor([datetime.date(2013, 4, 29), Decimal("1.50")])
+
+        self.assertEqual(decode_cursor(cursor), [u"2013-04-29", 1.5])
+
+    def test_cursor_is_url_safe(self):
+
+        cursor = encode_cursor([u"???>>>", 2 ** 40])
+
+        self.assertFalse(set(cursor) & set("+/"))
+
+    def test_invalid_cursor(self):
+
+        for cursor in ("not a cursor", encode_cursor([1])[:-3], "eyJhIjogMX0=", ""):
+            self.assertRaises(ValueError, decode_cursor, cursor)
+
+    def test_next_cursor(self):
+
+        page = KeysetPage(lambda row: [row], 3)
+        self.assertEqual(list(page.rows([1, 2, 3])), [1, 2, 3])
+        self.assertEqual(decode_cursor(page.next_cursor()), [3])
+
+    def test_no_next_cursor_after_a_short_page(self):
+
+        page = KeysetPage(lambda row: [row], 3)
+        list(page.rows([1, 2]))
+        self.assertEqual(page.next_cursor(), None)
+
+        page = KeysetPage(lambda row: [row], None)
+        list(page.rows([1, 2, 3]))
+        self.assertEqual(page.next_cursor(), None)
+
+class KeysetQueryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        self.Session = scoped_session(sessionmaker(bind=engine))
+        self.Session.add_all([Village(id=i + 1, name=n) for i, n in enumerate(NAMES)])
+        self.Session.commit()
+
+        self.protocol = FormatsProtocol(self.Session, Village, 'wkb_geometry')
+
+    def tearDown(self):
+
+        self.Session.remove()
+
+    def pages(self, params, entities=None):
+        """
+        Return the ids of all pages, following the cursors.
+        """
+
+        pages = []
+        params = dict(params)
+
+        while True:
+            request = JobRequest(params)
+            query = self.protocol._build_query(request, filter=Village.id != None, entities=entities, keyset=True)
+            page = self.protocol._keyset_page(request)
+            pages.append([row.id for row in page.rows(query)])
+
+            cursor = page.next_cursor()
+            if cursor is None:
+                return pages
+            params['cursor'] = cursor
+
+    def test_pages_by_primary_key(self):
+
+        pages = self.pages({'limit': '4'})
+
+        self.assertEqual(pages, [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]])
+
+    def test_pages_by_column_with_ties(self):
+
+        expected = [v.id for v in self.Session.query(Village).order_by(Village.name, Village.id)]
+
+        pages = self.pages({'limit': '3', 'order_by': 'name'})
+
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual([len(p) for p in pages], [3, 3, 3, 1])
+
+    def test_pages_descending(self):
+
+        expected = [v.id for v in self.Session.query(Village).order_by(Village.name.desc(), Village.id.desc())]
+
+        pages = self.pages({'limit': '4', 'order_by': 'name', 'dir': 'DESC'})
+
+        self.assertEqual(sum(pages, []), expected)
+
+    def test_pages_of_columns(self):
+
+        pages = self.pages({'limit': '3', 'order_by': 'name'}, entities=[Village.id, Village.name])
+
+        self.assertEqual(sorted(sum(pages, [])), list(range(1, 11)))
+
+    def test_last_full_page_is_followed_by_an_empty_one(self):
+
+        pages = self.pages({'limit': '5'})
+
+        self.assertEqual(pages, [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10], []])
+
+    def test_cursor_of_another_keyset(self):
+
+        params = {'limit': '3', 'order_by': 'name', 'cursor': encode_cursor([4])}
+
+        self.assertRaises(Exception, self.protocol._build_query, JobRequest(params),
+                          filter=Village.id != None, keyset=True)
+
+if __name__ == "__main__":
+    unittest.main()
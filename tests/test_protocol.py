@@ -0,0 +1,157 @@
+#
+# mapnik_formats
+# Copyright (C) 2013 Centre for Development and Environment, University of Bern
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests of the attribute filters of ``logical_attr_filter`` against an
+in-memory SQLite database.
+"""
+
+__author__ = "Adrian Weber, Centre for Development and Environment, University of Bern"
+__date__ = "$Oct 17, 2026 8:02:15 PM$"
+
+from papyrus_formats.jobs import JobRequest
+from papyrus_formats.protocol import attr_filter_cache
+from papyrus_formats.protocol import logical_attr_filter
+from sqlalchemy import Column
+from sqlalchemy import Float
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+import unittest
+
+Base = declarative_base()
+
+class Parcel(Base):
+    __tablename__ = "parcel"
+
+    id = Column(Integer, primary_key=True)
+    did = Column(Integer)
+    name = Column(String(40))
+    area = Column(Float)
+
+PARCELS = [
+    (1, 101, u"north field", 12.5),
+    (2, 102, u"south field", 3.0),
+    (3, 103, u"river meadow", 7.25),
+    (4, 102, u"north meadow", 20.0),
+    (5, 104, u"orchard", 1.5)
+]
+
+class LogicalAttrFilterTest(unittest.TestCase):
+
+    def setUp(self):
+
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.session.add_all([Parcel(id=i, did=d, name=n, area=a) for i, d, n, a in PARCELS])
+        self.session.commit()
+
+        attr_filter_cache.invalidate()
+
+    def tearDown(self):
+
+        self.session.close()
+
+    def ids(self, params):
+
+        f = logical_attr_filter(JobRequest(params), Parcel)
+        query = self.session.query(Parcel.id)
+        if f is not None:
+            query = query.filter(f)
+
+        return sorted(i for i, in query)
+
+    def test_without_queryable(self):
+
+        self.assertEqual(logical_attr_filter(JobRequest({'did__eq': '102'}), Parcel), None)
+
+    def test_values_are_coerced(self):
+
+        self.assertEqual(self.ids({'queryable': 'did', 'did__eq': '102'}), [2, 4])
+        self.assertEqual(self.ids({'queryable': 'area', 'area__gt': '7.25'}), [1, 4])
+
+    def test_several_values_are_in(self):
+
+        self.assertEqual(self.ids({'queryable': 'did', 'did__eq': '101,103'}), [1, 3])
+        self.assertEqual(self.ids({'queryable': 'did', 'did__ne': '101,102'}), [3, 5])
+
+    def test_not_queryable_parameters_are_ignored(self):
+
+        self.assertEqual(self.ids({'queryable': 'did', 'did__eq': '101', 'area__gt': '5'}), [1])
+
+    def test_logical_op(self):
+
+        params = {'queryable': 'did,area', 'did__eq': '102', 'area__gt': '10'}
+
+        self.assertEqual(self.ids(params), [1, 2, 4])
+        self.assertEqual(self.ids(dict(params, logical_op='and')), [4])
+        self.assertEqual(self.ids(dict(params, logical_op='not')), [3, 5])
+
+    def test_logical_expr(self):
+
+        params = {
+            'queryable': 'did,name,area',
+            'did__eq': '102,103',
+            'name__like': u'north%',
+            'area__gt': '5',
+            'logical_expr': 'and(or(did__eq,name__like),area__gt)'
+        }
+
+        self.assertEqual(self.ids(params), [1, 3, 4])
+        self.assertEqual(self.ids(dict(params, logical_expr='or(not(did__eq),area__gt)')), [1, 3, 4, 5])
+
+    def test_logical_expr_leaves_out_missing_operands(self):
+
+        params = {'queryable': 'did', 'did__eq': '104', 'logical_expr': 'and(did__eq,area__gt)'}
+
+        self.assertEqual(self.ids(params), [5])
+
+    # abort raises the HTTP error of the web framework in use
+    def test_malformed_logical_expr(self):
+
+        for expr in ('and(did__eq', 'and(did__eq,)', 'did__eq)', 'and()', 'or(did__eq area__gt)'):
+            params = {'queryable': 'did,area', 'did__eq': '102', 'area__gt': '5', 'logical_expr': expr}
+            self.assertRaises(Exception, logical_attr_filter, JobRequest(params), Parcel)
+
+    def test_invalid_number(self):
+
+        self.assertRaises(Exception, logical_attr_filter, JobRequest({'queryable': 'did', 'did__eq': 'abc'}), Parcel)
+
+    def test_filters_are_cached_per_signature(self):
+
+        params = {'queryable': 'did', 'did__eq': '102', 'limit': '10'}
+
+        f = logical_attr_filter(JobRequest(params), Parcel)
+
+        # Parameters outside of the signature don't matter
+        self.assertTrue(logical_attr_filter(JobRequest(dict(params, limit='20', _dc='1')), Parcel) is f)
+        self.assertFalse(logical_attr_filter(JobRequest(dict(params, did__eq='103')), Parcel) is f)
+        self.assertFalse(logical_attr_filter(JobRequest(dict(params, logical_op='not')), Parcel) is f)
+
+    def test_cached_filter_gives_the_same_rows(self):
+
+        params = {'queryable': 'did,area', 'did__eq': '102', 'area__gt': '10', 'logical_op': 'and'}
+
+        self.assertEqual(self.ids(params), [4])
+        self.assertEqual(self.ids(params), [4])
+
+if __name__ == "__main__":
+    unittest.main()